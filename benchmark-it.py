@@ -0,0 +1,272 @@
+"""
+Benchmark the Catchfish hot paths against the bundled fake UCI engine and the in-process store,
+so it runs on any Linux machine without Stockfish binaries or a Redis server.
+
+    python benchmark-it.py --games 20 --plies 80 --nodes 1M --json bench.json
+
+Each stage reports ops/sec and peak Python memory (tracemalloc, measured in a second pass so
+it doesn't skew the timings). The import and cli_start stages time importing catchfish and
+starting the command line in a fresh interpreter.
+
+With --continuous the evaluation is repeated in game-continuous mode (forward and reverse), and
+every evaluation stage also reports how often its top move agrees with a reference search at
+4x the node budget. The fake engine has no hash, so the numbers only mean something with
+--binaries-folder pointing at real Stockfish builds.
+"""
+
+from catchfish import (
+    Analysis,
+    Evaluation,
+    Games,
+    MemoryStore,
+    StockfishVariant,
+)
+from tests.fake_stockfish import make_binaries_folder, make_pgn
+import io, os, re, sys, json, argparse, tempfile, subprocess, tracemalloc
+from timeit import default_timer
+
+
+class Benchmark:
+    """
+    Runs the benchmark stages and collects ops/sec and peak memory for each.
+    """
+
+    def __init__(
+        self,
+        num_games=10,
+        plies=60,
+        num_nodes="1M",
+        multi_pv=3,
+        latency=0,
+        binaries_folder=None,
+        measure_memory=True,
+        continuous=False,
+    ):
+        self._num_games = num_games
+        self._plies = plies
+        self._num_nodes = num_nodes
+        self._multi_pv = multi_pv
+        self._measure_memory = measure_memory
+        self._continuous = continuous
+        self._results = []
+
+        os.environ["FAKE_STOCKFISH_LATENCY"] = str(latency)
+        self._tmp = tempfile.TemporaryDirectory()
+        self._binaries_folder = binaries_folder or make_binaries_folder(
+            self._tmp.name, versions=[15]
+        )
+        self._pgn = make_pgn(num_games=num_games, plies=plies)
+
+    def run(self):
+        self._stage("import", self._import)
+        self._stage("cli_start", self._cli_start)
+        self._stage("pgn_ingest", self._ingest)
+        self._stage("position_extraction", self._extract_positions)
+        self._stage("evaluation", self._evaluate)
+        self._stage("store_round_trip", self._store_round_trip)
+        self._stage("analysis", self._analyse)
+        if self._continuous:
+            self._compare_continuous()
+        return self._results
+
+    def _compare_continuous(self):
+        results = {"evaluation": self._evaluation.get_results()}
+        for name, reverse in (
+            ("evaluation_continuous", False),
+            ("evaluation_continuous_reverse", True),
+        ):
+            self._stage(name, lambda: self._evaluate_continuous(reverse))
+            results[name] = self._continuous_evaluation.get_results()
+
+        reference = self._run_evaluation(
+            num_nodes=StockfishVariant.parse_num_nodes(self._num_nodes) * 4
+        )
+        reference_moves = self._top_moves(reference.get_results())
+        for r in self._results:
+            if r["stage"] in results:
+                moves = self._top_moves(results[r["stage"]])
+                agree = sum(1 for a, b in zip(moves, reference_moves) if a == b)
+                r["top_move_agreement"] = round(agree / max(len(moves), 1), 3)
+
+    def _evaluate_continuous(self, reverse):
+        self._continuous_evaluation = self._run_evaluation(
+            continuous=True, reverse=reverse
+        )
+        return sum(len(g.get_positions()) for g in self._games.get_games())
+
+    def _run_evaluation(self, num_nodes=None, **kwargs):
+        evaluation = Evaluation(
+            games=self._games,
+            stockfish_versions=[15],
+            log_level="none",
+            threads=1,
+            hash=16,
+            multi_pv=self._multi_pv,
+            num_nodes=[num_nodes or self._num_nodes],
+            store=MemoryStore(log_level="none"),
+            binaries_folder=self._binaries_folder,
+            **kwargs,
+        )
+        evaluation.evaluate()
+        evaluation._stockfish_variant.quit()
+        return evaluation
+
+    def _top_moves(self, results):
+        moves = []
+        for result in results:
+            for item in result["evaluation"]:
+                moves.append(
+                    item["evaluation"][0]["Move"] if item["evaluation"] else None
+                )
+        return moves
+
+    def _stage(self, name, func):
+        start = default_timer()
+        ops = func()
+        elapsed = default_timer() - start
+
+        peak = None
+        if self._measure_memory:
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        result = {
+            "stage": name,
+            "ops": ops,
+            "seconds": round(elapsed, 4),
+            "ops_per_sec": round(ops / elapsed, 1) if elapsed > 0 else None,
+            "peak_memory_kb": round(peak / 1024, 1) if peak is not None else None,
+        }
+        if name == "import":
+            result["import_ms"] = self._import_ms
+        self._results.append(result)
+
+    def _load_games(self):
+        return Games(
+            pgn=io.StringIO(self._pgn),
+            stockfish_variant=StockfishVariant(),
+            log_level="none",
+        )
+
+    def _import(self):
+        # in a fresh interpreter, the cumulative import time of catchfish as reported by -X
+        # importtime lands in the results as import_ms
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import catchfish"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stderr
+        match = re.search(r"\|\s*(\d+) \| catchfish$", output, re.MULTILINE)
+        self._import_ms = int(match.group(1)) / 1000 if match else None
+        return 1
+
+    def _cli_start(self):
+        subprocess.run(
+            [sys.executable, "-m", "catchfish", "--help"],
+            capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return 1
+
+    def _ingest(self):
+        return self._load_games().get_valid_games_count()
+
+    def _extract_positions(self):
+        positions = 0
+        for game in self._games.get_games():
+            positions += len(game.get_positions())
+        return positions
+
+    def _evaluate(self):
+        self._evaluation = self._run_evaluation()
+        return sum(len(g.get_positions()) for g in self._games.get_games())
+
+    def _store_round_trip(self):
+        store = MemoryStore(log_level="none")
+        results = self._evaluation.get_results()
+        for i, result in enumerate(results):
+            for item in result["evaluation"]:
+                store.set("position:{}".format(i), item["evaluation"])
+                store.get("position:{}".format(i))
+        return sum(len(result["evaluation"]) for result in results)
+
+    def _analyse(self):
+        results = self._evaluation.get_results()
+        for result in results:
+            Analysis(evaluation=result, log_level="none").analyse()
+        return len(results)
+
+    @property
+    def _games(self):
+        if not hasattr(self, "_loaded_games"):
+            self._loaded_games = self._load_games()
+        return self._loaded_games
+
+
+def print_results(results):
+    print(
+        "{:<30} {:>8} {:>10} {:>12} {:>14}".format(
+            "stage", "ops", "seconds", "ops/sec", "peak mem (KB)"
+        )
+    )
+    for r in results:
+        print(
+            "{:<30} {:>8} {:>10} {:>12} {:>14}".format(
+                r["stage"],
+                r["ops"],
+                r["seconds"],
+                str(r["ops_per_sec"]),
+                str(r["peak_memory_kb"]),
+            )
+        )
+    for r in results:
+        if r.get("import_ms") is not None:
+            print("import catchfish: {} ms".format(r["import_ms"]))
+        if "top_move_agreement" in r:
+            print(
+                "{} top move agreement with 4x nodes: {}".format(
+                    r["stage"], r["top_move_agreement"]
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Catchfish hot paths.")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--plies", type=int, default=60)
+    parser.add_argument("--nodes", default="1M")
+    parser.add_argument("--multi-pv", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="fake engine seconds per 1M nodes"
+    )
+    parser.add_argument(
+        "--binaries-folder", help="use real Stockfish binaries instead of the fake"
+    )
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument(
+        "--continuous",
+        action="store_true",
+        help="compare game-continuous search against fresh searches",
+    )
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(
+        num_games=args.games,
+        plies=args.plies,
+        num_nodes=args.nodes,
+        multi_pv=args.multi_pv,
+        latency=args.latency,
+        binaries_folder=args.binaries_folder,
+        measure_memory=not args.no_memory,
+        continuous=args.continuous,
+    )
+    results = benchmark.run()
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(results, indent=2))
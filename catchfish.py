@@ -1,7 +1,241 @@
-import os, io, sys, json, redis, hashlib, inspect, datetime
-from stockfish import Stockfish, StockfishException
-import chess, chess.pgn
-from pydash.strings import slugify
+import os, io, sys, json, mmap, time, struct, fnmatch, hashlib, inspect, datetime
+import threading, functools, importlib, contextlib
+
+
+class _LazyModule:
+    """
+    Module imported on first use, so importing catchfish, or starting the command line,
+    doesn't pay for redis, stockfish, chess and pydash before they're needed.
+    """
+
+    def __init__(self, name, *submodules):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for submodule in self._submodules:
+                importlib.import_module(self._name + "." + submodule)
+            self._module = module
+        return getattr(self._module, attr)
+
+
+redis = _LazyModule("redis")
+stockfish = _LazyModule("stockfish")
+chess = _LazyModule("chess", "pgn", "polyglot")
+pydash = _LazyModule("pydash", "strings")
+
+
+class Profiler:
+    """
+    Stage timers for the hot paths: PGN parsing, board replay, engine search, the store, JSON
+    and analysis. Disabled until started, when a stage costs one attribute lookup. Nested
+    stages are timed inclusive and on their own (self), eg. the self time of evaluate_game is
+    the Python overhead around engine and store. With mode "cprofile", every stage is also
+    profiled with cProfile, and with "sample", stacks are sampled every interval seconds and
+    counted per stage.
+    """
+
+    modes = ["timers", "cprofile", "sample"]
+
+    _active = None
+
+    def __init__(self, mode="timers", interval=0.005, top=15, log_level="info"):
+        if mode not in self.modes:
+            raise ValueError("Unknown profiler mode: {}".format(mode))
+        self._mode = mode
+        self._interval = interval
+        self._top = top
+        self._totals = {}
+        self._profiles = {}
+        self._samples = {}
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+
+    def start(self):
+        Profiler._active = self
+        if self._mode == "sample" and self._sampler is None:
+            self._sampling = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        self._logger.info("Profiling in mode", self._mode)
+        return self
+
+    def stop(self):
+        if Profiler._active is self:
+            Profiler._active = None
+        if self._sampler is not None:
+            self._sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    @classmethod
+    def stage(cls, name):
+        """
+        Decorator timing a function as a stage, while a profiler is started
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                profiler = cls._active
+                if profiler is None:
+                    return func(*args, **kwargs)
+                profiler._enter(name)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler._exit()
+
+            return wrapper
+
+        return decorator
+
+    def _enter(self, name):
+        stack = self._stacks.setdefault(threading.get_ident(), [])
+        if self._mode == "cprofile":
+            if stack and stack[-1]["profile"] is not None:
+                stack[-1]["profile"].disable()
+            profile = self._profiles.get((name, threading.get_ident()))
+            if profile is None:
+                import cProfile
+
+                profile = cProfile.Profile()
+                self._profiles[(name, threading.get_ident())] = profile
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler at a time, across all threads
+                profile = None
+        else:
+            profile = None
+        stack.append(
+            {
+                "name": name,
+                "started": time.perf_counter(),
+                "children": 0.0,
+                "profile": profile,
+            }
+        )
+
+    def _exit(self):
+        stack = self._stacks[threading.get_ident()]
+        frame = stack.pop()
+        if frame["profile"] is not None:
+            frame["profile"].disable()
+            if stack and stack[-1]["profile"] is not None:
+                stack[-1]["profile"].enable()
+        elapsed = time.perf_counter() - frame["started"]
+        if stack:
+            stack[-1]["children"] += elapsed
+        with self._lock:
+            totals = self._totals.setdefault(frame["name"], [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+            totals[2] += elapsed - frame["children"]
+
+    def _sample(self):
+        # count the innermost function of every thread that is in a stage, per stage
+        while not self._sampling.wait(self._interval):
+            frames = sys._current_frames()
+            for ident, stack in list(self._stacks.items()):
+                try:
+                    name = stack[-1]["name"]
+                except IndexError:
+                    continue
+                if ident not in frames:
+                    continue
+                code = frames[ident].f_code
+                function = "{}:{}({})".format(
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno,
+                    code.co_name,
+                )
+                samples = self._samples.setdefault(name, {})
+                samples[function] = samples.get(function, 0) + 1
+
+    def get_summary(self):
+        """
+        Calls, inclusive and self seconds per stage, the most expensive first
+        """
+        with self._lock:
+            totals = dict(self._totals)
+        total_self = sum(t[2] for t in totals.values()) or 1.0
+        return [
+            {
+                "stage": name,
+                "calls": calls,
+                "seconds": round(seconds, 4),
+                "self_seconds": round(self_seconds, 4),
+                "self_share": round(self_seconds / total_self, 3),
+                "ms_per_call": round(seconds * 1000 / calls, 3),
+            }
+            for name, (calls, seconds, self_seconds) in sorted(
+                totals.items(), key=lambda t: -t[1][2]
+            )
+        ]
+
+    def report(self, path=None):
+        """
+        Summary report as text, with the top functions per stage when profiling or sampling.
+        Written to path if given.
+        """
+        lines = [
+            "{:<20} {:>10} {:>12} {:>12} {:>8} {:>12}".format(
+                "stage", "calls", "seconds", "self", "share", "ms/call"
+            )
+        ]
+        summary = self.get_summary()
+        for item in summary:
+            lines.append(
+                "{:<20} {:>10} {:>12} {:>12} {:>8} {:>12}".format(
+                    item["stage"],
+                    item["calls"],
+                    item["seconds"],
+                    item["self_seconds"],
+                    item["self_share"],
+                    item["ms_per_call"],
+                )
+            )
+        for item in summary:
+            lines.extend(self._report_stage(item["stage"]))
+
+        report = "\n".join(lines) + "\n"
+        if path:
+            with open(path, "w") as f:
+                f.write(report)
+            self._logger.info("Profile written to", path)
+        return report
+
+    def _report_stage(self, name):
+        if self._mode == "cprofile":
+            import pstats
+
+            profiles = [p for (n, _), p in self._profiles.items() if n == name]
+            if not profiles:
+                return []
+            out = io.StringIO()
+            stats = pstats.Stats(*profiles, stream=out)
+            stats.sort_stats("cumulative").print_stats(self._top)
+            return ["", "== {} ==".format(name), out.getvalue().strip()]
+        if self._mode == "sample":
+            samples = self._samples.get(name, {})
+            total = sum(samples.values())
+            if not total:
+                return []
+            lines = ["", "== {} ({} samples) ==".format(name, total)]
+            for function, count in sorted(samples.items(), key=lambda i: -i[1])[
+                : self._top
+            ]:
+                lines.append("{:>6.1%}  {}".format(count / total, function))
+            return lines
+        return []
 
 
 class Catchfish:
@@ -32,6 +266,21 @@ class Catchfish:
         mode="nodes",
         engine_log_file="debug.log",
         raw_output=False,
+        metrics_file=None,
+        status_file=None,
+        processes=1,
+        pin=False,
+        continuous=False,
+        reverse=False,
+        redis_host="localhost",
+        redis_port=6379,
+        redis_db=1,
+        binaries_folder=None,
+        early_stop=None,
+        adaptive_multi_pv=None,
+        analysis_ttl=604800,
+        profile=None,
+        profile_file=None,
     ):
         self._limit_games = limit_games
         self._stockfish_versions = stockfish_versions
@@ -45,6 +294,21 @@ class Catchfish:
         self._mode = mode
         self._engine_log_file = engine_log_file
         self._raw_output = raw_output
+        self._metrics_file = metrics_file
+        self._status_file = status_file
+        self._processes = processes
+        self._pin = pin
+        self._continuous = continuous
+        self._reverse = reverse
+        self._redis_host = redis_host
+        self._redis_port = redis_port
+        self._redis_db = redis_db
+        self._binaries_folder = binaries_folder
+        self._early_stop = early_stop
+        self._adaptive_multi_pv = adaptive_multi_pv
+        self._analysis_ttl = analysis_ttl
+        self._profile_file = profile_file
+        self._store = None
 
         self._logger = Logger(level=self._log_level)
         self._logger.info("Initiated")
@@ -53,61 +317,241 @@ class Catchfish:
         self.games = None
         self.evaluation = None
         self.analysis = None
+        self.comparison = None
 
-    def load_games(self, path):
+        # stages are timed from here on, until profile_report
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler(
+                mode="timers" if profile is True else profile, log_level=self._log_level
+            ).start()
+
+    def profile_report(self, path=None):
+        """
+        Stop profiling and return the report, written to path or profile_file if given
+        """
+        if self.profiler is None:
+            return None
+        self.profiler.stop()
+        return self.profiler.report(path or self._profile_file)
+
+    def load_games(self, path, skip_stored_games=False, **filters):
+        """
+        Load games from a PGN file, or a list of them. Filters (players, events, date_from,
+        date_to, min_elo, results) are applied on the headers, before any moves are read.
+        Duplicate games are dropped, with skip_stored_games also games stored by earlier runs
+        with every engine version and node budget of this instance.
+        """
+        fingerprint_settings = None
+        if skip_stored_games:
+            fingerprint_settings = Evaluation(
+                store=self.get_store(),
+                log_level="none",
+                **self._get_evaluation_settings(),
+            ).get_settings_ids()
         self.games = Games(
-            path=path,
             log_level=self._log_level,
             limit_games=self._limit_games,
+            fingerprint_store=self.get_store() if skip_stored_games else None,
+            fingerprint_settings=fingerprint_settings,
+            **filters,
         )
+        for pgn_path in [path] if isinstance(path, str) else path:
+            self.games.read_file(pgn_path)
         self._logger.info("Games found: {}".format(len(self.games.get_games())))
         self._logger.info(
             "Invalid games found: {}".format(self.games.get_invalid_games_count())
         )
+        self._logger.info(
+            "Duplicate games skipped: {}".format(self.games.get_duplicate_games_count())
+        )
 
-    def evaluate(self):
+    def evaluate(
+        self, distributed=False, local_workers=None, priority="normal", batch=None
+    ):
         """
-        Evaluate a pgn file
+        Evaluate a pgn file. With more than one process (see tune), or distributed, positions are
+        evaluated by workers through the store; remote hosts can join by running work().
+        Distributed, positions are queued with priority (interactive, normal or batch) as a
+        batch, sharing the workers fairly with other batches of the same priority.
         """
-
         self.evaluation = Evaluation(
             games=self.games,
+            log_level=self._log_level,
+            engine_log_file=self._engine_log_file,
+            metrics_file=self._metrics_file,
+            status_file=self._status_file,
+            local_workers=self._processes if local_workers is None else local_workers,
+            pin=self._pin,
+            priority=priority,
+            batch=batch,
+            store=self.get_store(),
+            binaries_folder=self._binaries_folder,
+            **self._get_evaluation_settings(distributed),
+        )
+        self._logger.info("Starting evaluation")
+        self.evaluation.evaluate()
+        self._logger.info("Evaluation finished")
+
+        return self.evaluation
+
+    def _get_evaluation_settings(self, distributed=False):
+        # the settings that evaluations are stored with
+        return dict(
             stockfish_versions=self._stockfish_versions,
             historical=self._historical,
-            log_level=self._log_level,
             threads=self._threads,
             hash=self._hash,
             depth=self._depth,
             multi_pv=self._multi_pv,
             num_nodes=self._num_nodes,
             mode=self._mode,
-            engine_log_file=self._engine_log_file,
             raw_output=self._raw_output,
+            distributed=distributed or self._processes > 1,
+            continuous=self._continuous,
+            reverse=self._reverse,
+            early_stop=self._early_stop,
+            adaptive_multi_pv=self._adaptive_multi_pv,
         )
-        self._logger.info("Starting evaluation")
-        self.evaluation.evaluate()
-        self._logger.info("Evaluation finished")
 
-        return self.evaluation
+    def work(self, stop_when_empty=False, **kwargs):
+        """
+        Run a worker evaluating positions queued by a distributed evaluation
+        """
+        worker = Worker(log_level=self._log_level, **kwargs)
+        return worker.run(stop_when_empty=stop_when_empty)
+
+    def tune(self, sample_size=20, hash_sizes=None, apply=True, **kwargs):
+        """
+        Benchmark Threads/Hash/process layouts on a sample of the loaded games, and apply the
+        fastest one to this instance, including the CPU pinning it was measured with
+        """
+        tuner = Tuner(
+            games=self.games,
+            stockfish_version=self._stockfish_versions[0],
+            num_nodes=self._num_nodes[0],
+            multi_pv=self._multi_pv,
+            sample_size=sample_size,
+            hash_sizes=hash_sizes or [self._hash],
+            log_level=self._log_level,
+            **kwargs,
+        )
+        best = tuner.tune()
+        self._logger.info("Best layout:", best)
 
-    def analyse(self, evaluation=None, log_level=None):
+        if apply and best:
+            self._processes = best["processes"]
+            self._threads = best["threads"]
+            self._hash = best["hash"]
+            self._pin = kwargs.get("pin", True)
+
+        return best
+
+    def analyse(self, evaluation=None, log_level=None, key=None, **parameters):
         """
-        Analyse an evaluation
+        Analyse an evaluation, or the one stored as key. By key, results are cached in the
+        store for analysis_ttl seconds, so a repeated analysis costs one read. parameters
+        are passed on to Analysis.analyse
         """
         self._logger.info("Analyse evaluation")
         self.analysis = Analysis(
-            evaluation=evaluation or self.evaluation,
+            evaluation=evaluation or (self.evaluation if key is None else None),
             log_level=log_level or self._log_level,
+            store=self.get_store() if key is not None else None,
+            key=key,
+            ttl=self._analysis_ttl,
         )
-        self._analysis_result = self.analysis.analyse()
+        self._analysis_result = self.analysis.analyse(**parameters)
         self._logger.info("Analysis finished")
 
         return self._analysis_result
 
+    def compare(self, evaluations=None, top_n=3, name=None, **filters):
+        """
+        Compare evaluations of the same games across engine versions and node budgets. With
+        a name, the comparison is kept in the store and updated: without evaluations, only
+        the stored games of this instance's versions and node budgets that it doesn't
+        include yet are read and merged. Filters such as player, event, date_from and
+        date_to narrow the stored games, see find_keys.
+        """
+        self._logger.info("Compare evaluations")
+        state = None
+        if name is not None:
+            state = self.get_store().get("comparison:" + name)
+        self.comparison = Comparison(
+            top_n=top_n, state=state, log_level=self._log_level
+        )
+
+        if evaluations is None and name is not None:
+            keys = []
+            for version in self._stockfish_versions:
+                for num_nodes in self._num_nodes:
+                    keys += self.find_keys(
+                        version=version, num_nodes=num_nodes, **filters
+                    )
+            keys = [key for key in keys if not self.comparison.has_key(key)]
+            self._logger.info("Adding", len(keys), "evaluations to comparison", name)
+            evaluations = self.get_evaluations(keys) if keys else []
+        for evaluation in (
+            self.evaluation.get_results() if evaluations is None else evaluations
+        ):
+            self.comparison.add(evaluation)
+
+        if name is not None:
+            self.get_store().set("comparison:" + name, self.comparison.get_state())
+        return self.comparison.compare()
+
+    def export_archive(self, path, prefixes=("position:", "game:")):
+        """
+        Append the stored evaluations to an on-disk archive, see Archive
+        """
+        return Archive(path, log_level=self._log_level).export_store(
+            self.get_store(), prefixes=prefixes
+        )
+
+    def import_archive(self, path):
+        """
+        Load an on-disk archive into the store
+        """
+        return Archive(path, log_level=self._log_level).import_store(self.get_store())
+
+    def get_store(self):
+        """
+        Store shared by everything this instance runs, connections are pooled per server
+        """
+        if self._store is None:
+            self._store = RedisStore(
+                host=self._redis_host,
+                port=self._redis_port,
+                db=self._redis_db,
+                log_level=self._log_level,
+            )
+        return self._store
+
     def get_evaluation_by_key(self, key):
-        e = Evaluation(log_level="none")
+        e = Evaluation(store=self.get_store(), log_level="none")
         return json.dumps(e.get_result_by_key(key))
 
+    def find_keys(self, **filters):
+        """
+        Find stored games by player, event, version, num_nodes and date_from/date_to
+        """
+        return GameIndex(self.get_store(), log_level=self._log_level).find(**filters)
+
+    def reindex(self):
+        """
+        Add every stored game to the indexes used by find_keys, see GameIndex.reindex
+        """
+        return GameIndex(self.get_store(), log_level=self._log_level).reindex()
+
+    def get_evaluations(self, keys=None, prefix="game:", batch_size=500):
+        """
+        Stream stored game evaluations, read in batches. Without keys, every key with the
+        prefix is read.
+        """
+        e = Evaluation(store=self.get_store(), log_level="none")
+        return e.get_evaluations(keys=keys, prefix=prefix, batch_size=batch_size)
+
 
 class Logger:
     """
@@ -156,58 +600,58 @@ class Analysis:
     Class for analysing evaluated games and create aggregated statistics, like centipawnloss,
     wdl-changes, etc. Takes Evaluation result and outputs Analysis result.
 
+    With a store and the key of the evaluation, results are cached in the store for ttl
+    seconds, per version and parameters. Given only the key, the evaluation is read from
+    the store when the result isn't cached.
     """
 
-    def __init__(self, evaluation=None, log_level="info"):
+    # bump when the output of analyse changes, so older cached results are not used
+    version = 1
+
+    def __init__(
+        self, evaluation=None, log_level="info", store=None, key=None, ttl=604800
+    ):
         self._analysis = {}
         self._moves = []
-        self._stockfish_variant = None
         self._evaluation = evaluation
+        self._store = store
+        self._key = key
+        self._ttl = ttl
 
         self._log_level = log_level
         self._logger = Logger(level=self._log_level)
         self._logger.info("Initiated")
 
-        self._initiate_stockfish_variant()
-        self._initiate_evaluation()
-
-    def _initiate_stockfish_variant(self, stockfish_version=15, threads=32):
-        if self._stockfish_variant is not None:
-            self._stockfish_variant.quit()
-
-        self._stockfish_variant = StockfishVariant(
-            version=stockfish_version,
-            threads=threads,
-            log_level=self._log_level,
-            initiate=True,
-        )
+        if self._evaluation is not None:
+            self._initiate_evaluation()
 
+    @Profiler.stage("analysis_replay")
     def _initiate_evaluation(self):
-        # create moves by parsing PGN
+        # create moves by replaying PGN on a single board, keeping only what analysis needs
         self._pgn = io.StringIO(self._evaluation["pgn"])
         self._game = Game(
             game=chess.pgn.read_game(self._pgn), log_level=self._log_level
         )
-        self._boards = self._game.get_boards()
 
         moves = []
-
-        for i, board in enumerate(self._boards):
+        board = self._game.get_game().board()
+        mainline = list(self._game.get_game().mainline_moves())
+        for i, next_move in enumerate(mainline):
             moves.append(
-                {
-                    "board": board,
-                    "fullmove_number": board.fullmove_number,
-                    "ply": board.ply() + 1,
-                    "turn": "white" if board.turn else "black",
-                    "move": self._boards[i + 1].peek().uci()
-                    if len(self._boards) > i + 1
-                    else None,
-                    "is_check": board.is_check(),
-                    "is_checkmate": board.is_checkmate(),
-                    "is_stalemate": board.is_stalemate(),
-                    "is_insufficient_material": board.is_insufficient_material(),
-                }
+                MoveRecord(
+                    fullmove_number=board.fullmove_number,
+                    ply=board.ply() + 1,
+                    turn="white" if board.turn else "black",
+                    move=next_move.uci() if len(mainline) > i + 1 else None,
+                    is_check=board.is_check(),
+                    is_checkmate=board.is_checkmate(),
+                    is_stalemate=board.is_stalemate(),
+                    is_insufficient_material=board.is_insufficient_material(),
+                    legal_moves_count=self._get_num_legal_moves(board),
+                    material_count=self._get_material(board),
+                )
             )
+            board.push(next_move)
 
         for idx, e_move in enumerate(self._evaluation["evaluation"]):
             moves[idx].update(e_move)
@@ -215,9 +659,37 @@ class Analysis:
         self._moves = moves
         self._logger.verbose("Moves:", self._moves, len(self._moves))
 
-    def analyse(self, return_move_data=False):
+    def analyse(
+        self, return_move_data=False, ignore_first_moves=10, ignore_forced_moves=3
+    ):
+        """
+        Analyse the evaluation. The select moves statistics leave out the first
+        ignore_first_moves plies and positions with ignore_forced_moves legal moves or less.
+        """
         self._return_move_data = return_move_data
-        return self._analyse()
+        self._ignore_first_moves = ignore_first_moves
+        self._ignore_forced_moves = ignore_forced_moves
+
+        cache_key = None
+        if self._store is not None and self._key is not None:
+            cache_key = self._gen_cache_key()
+            cached = self._store.get(cache_key)
+            if cached is not None:
+                self._logger.debug("Analysis found in store", cache_key)
+                return cached
+
+        if self._evaluation is None:
+            self._evaluation = Evaluation(
+                store=self._store, log_level="none"
+            ).get_result_by_key(self._key)
+            if self._evaluation is None:
+                raise ValueError("No evaluation stored as {}".format(self._key))
+            self._initiate_evaluation()
+
+        result = self._analyse()
+        if cache_key is not None and not self._store.read_only:
+            self._store.set(cache_key, result, ttl=self._ttl)
+        return result
         # things to analyse:
         # - √ centipawnloss per move
         # - √ centipawnloss average for whole game
@@ -277,6 +749,17 @@ class Analysis:
         #   talking camera in contact lenses (a bit early for that). that means either tapping with toe (unlikely) — or
         #   outside help.
 
+    def _gen_cache_key(self):
+        parameters = [
+            self._key,
+            self._return_move_data,
+            self._ignore_first_moves,
+            self._ignore_forced_moves,
+        ]
+        digest = hashlib.md5(json.dumps(parameters).encode("utf-8")).hexdigest()
+        return "analysis:{}:{}".format(self.version, digest)
+
+    @Profiler.stage("analysis")
     def _analyse(self):
         self._position_depths = []
         self._move_depths = []
@@ -293,29 +776,29 @@ class Analysis:
         # per game
         self._analyse_game()
 
-        for move in self._moves:
-            move.pop("board")
-
-        if not self._return_move_data:
-            for move in self._moves:
-                move.pop("evaluation")
-
         return json.dumps(
             {
                 "info": self._game.get_info(),
                 "game": self._game_analysis,
-                "moves": self._moves,
+                "moves": [
+                    move.to_dict(include_evaluation=self._return_move_data)
+                    for move in self._moves
+                ],
             }
         )
 
     def _analyse_game(self):
         white_acl_all_moves = self._get_acl_all("white")
         white_acl_select_moves = self._get_acl_select(
-            turn="white", ignore_first_moves=10, ignore_forced_moves=3
+            turn="white",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
         white_wdl_delta_all_moves = self._get_awdl_all("white")
         white_wdl_delta_select_moves = self._get_awdl_select(
-            turn="white", ignore_first_moves=10, ignore_forced_moves=3
+            turn="white",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
         white_top_engine_moves = self._get_top_engine_moves("white")
         (
@@ -328,16 +811,22 @@ class Analysis:
             white_mistakes_select_moves,
             white_blunders_select_moves,
         ) = self._get_inaccuracies_select(
-            turn="white", ignore_first_moves=10, ignore_forced_moves=3
+            turn="white",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
 
         black_acl_all_moves = self._get_acl_all("black")
         black_acl_select_moves = self._get_acl_select(
-            turn="black", ignore_first_moves=10, ignore_forced_moves=3
+            turn="black",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
         black_wdl_delta_all_moves = self._get_awdl_all("black")
         black_wdl_delta_select_moves = self._get_awdl_select(
-            turn="black", ignore_first_moves=10, ignore_forced_moves=3
+            turn="black",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
         black_top_engine_moves = self._get_top_engine_moves("black")
         (
@@ -350,7 +839,9 @@ class Analysis:
             black_mistakes_select_moves,
             black_blunders_select_moves,
         ) = self._get_inaccuracies_select(
-            turn="black", ignore_first_moves=10, ignore_forced_moves=3
+            turn="black",
+            ignore_first_moves=self._ignore_first_moves,
+            ignore_forced_moves=self._ignore_forced_moves,
         )
 
         self._game_analysis = {
@@ -515,6 +1006,22 @@ class Analysis:
         return inaccuracies, mistakes, blunders
 
     def _analyse_move(self, move, idx):
+        if not move["evaluation"]:
+            # eg. a quarantined position, which has no engine evaluation
+            self._moves[idx].update(
+                {
+                    "centipawn_loss": None,
+                    "wdl_diff": None,
+                    "top_engine_move": None,
+                    "legal_moves": move.legal_moves_count,
+                    "material": move.material_count,
+                    "depth_of_position": None,
+                    "depth_of_move": None,
+                    "depths_of_move": [],
+                }
+            )
+            return
+
         centipawn_loss = self._get_centipawn_loss(move, idx)
         self._logger.debug("Centipawn loss: ", centipawn_loss)
 
@@ -524,10 +1031,10 @@ class Analysis:
         top_engine_move = self._get_top_move(move)
         self._logger.debug("Top move index: ", top_engine_move)
 
-        legal_moves_count = self._get_num_legal_moves(move)
+        legal_moves_count = move.legal_moves_count
         self._logger.debug("Legal moves count: ", legal_moves_count)
 
-        material = self._get_material(move)
+        material = move.material_count
         self._logger.debug("Material: ", material)
 
         depth_of_position = self._get_depth_of_position(move)
@@ -593,6 +1100,7 @@ class Analysis:
                     }
                 )
 
+        jd.sort()
         for n in range(1, depth_cutoff + 1):
             jd.remove(n) if n in jd else None
 
@@ -630,8 +1138,7 @@ class Analysis:
                     depths[d] = [e]
         return depths
 
-    def _get_material(self, move):
-        board = move["board"]
+    def _get_material(self, board):
         piece_map = board.piece_map()
         wm = 0
         bm = 0
@@ -659,8 +1166,8 @@ class Analysis:
         else:
             return 0
 
-    def _get_num_legal_moves(self, move):
-        return move["board"].legal_moves.count()
+    def _get_num_legal_moves(self, board):
+        return board.legal_moves.count()
 
     def _get_top_move(self, move):
         move_made = move["move"]
@@ -684,11 +1191,7 @@ class Analysis:
         if was_top_move is not None:
             player_move = was_top_move
         else:
-            player_move = (
-                self._moves[idx + 1]["evaluation"][0]
-                if len(self._moves) > idx + 1
-                else None
-            )
+            player_move = self._get_best_line(idx + 1)
 
         wdl_player = (
             player_move["WDL"]
@@ -726,12 +1229,12 @@ class Analysis:
                 else None
             )
         else:
+            next_best = self._get_best_line(idx + 1)
             cpl = (
-                self._moves[idx + 1]["evaluation"][0]["Centipawn"]
-                - move["evaluation"][0]["Centipawn"]
-                if len(self._moves) > idx + 1
+                next_best["Centipawn"] - move["evaluation"][0]["Centipawn"]
+                if next_best is not None
                 and move["evaluation"][0]["Centipawn"] is not None
-                and self._moves[idx + 1]["evaluation"][0]["Centipawn"] is not None
+                and next_best["Centipawn"] is not None
                 else None
             )
 
@@ -741,6 +1244,11 @@ class Analysis:
 
         return abs(cpl) if cpl is not None else None
 
+    def _get_best_line(self, idx):
+        if len(self._moves) > idx and self._moves[idx]["evaluation"]:
+            return self._moves[idx]["evaluation"][0]
+        return None
+
     def _get_move_made(self, move):
         self._logger.debug("Got a move: ", move)
         fen = move["position"]
@@ -749,12 +1257,337 @@ class Analysis:
         self._logger.debug("Got game moves: ", self._game_moves)
 
 
+class MoveRecord:
+    """
+    Compact per-move record used by Analysis. Replaces a dict and a full chess.Board per ply,
+    while still supporting the dict-style access the analysis methods use.
+    """
+
+    # order of fields is the order of keys in the analysis JSON output
+    _fields = (
+        "fullmove_number",
+        "ply",
+        "turn",
+        "move",
+        "is_check",
+        "is_checkmate",
+        "is_stalemate",
+        "is_insufficient_material",
+        "evaluation",
+        "position",
+        "centipawn_loss",
+        "wdl_diff",
+        "top_engine_move",
+        "legal_moves",
+        "material",
+        "depth_of_position",
+        "depth_of_move",
+        "depths_of_move",
+    )
+
+    __slots__ = _fields + ("legal_moves_count", "material_count", "_extra")
+
+    def __init__(self, legal_moves_count=None, material_count=None, **fields):
+        self.legal_moves_count = legal_moves_count
+        self.material_count = material_count
+        self._extra = None
+        self.update(fields)
+
+    def __getitem__(self, key):
+        try:
+            if key in self._fields:
+                return getattr(self, key)
+            if self._extra is not None:
+                return self._extra[key]
+        except AttributeError:
+            pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def update(self, fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def to_dict(self, include_evaluation=True):
+        result = {}
+        for key in self._fields:
+            if key == "evaluation" and not include_evaluation:
+                continue
+            if key in self:
+                result[key] = getattr(self, key)
+            if key == "position" and self._extra is not None:
+                result.update(self._extra)
+        return result
+
+
+class Comparison:
+    """
+    Class for comparing evaluations of the same games by several engine versions and node
+    budgets. Plies are aligned across the evaluations, and for every played move it finds the
+    weakest setting that has it as top move, or in the top n moves: its discovery strength.
+    Outputs top move agreement between settings, and discovery strengths per player.
+
+    Each evaluation, one game at one setting, is merged into the per-game and per-player
+    results once, so adding an engine version or node budget only processes the new
+    evaluations. The results keep which settings and evaluation keys they include, and can
+    be saved with get_state and passed back as state.
+    """
+
+    def __init__(self, evaluations=None, top_n=3, log_level="info", state=None):
+        self._top_n = top_n
+        self._games = {}
+        self._keys = set()
+        self._evaluated = {}
+        self._played_top_1 = {}
+        self._played_top_n = {}
+        self._agree = {}
+        self._both = {}
+        self._players = {}
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+        self._logger.info("Initiated")
+
+        if state is not None:
+            self._set_state(state)
+        for evaluation in evaluations or []:
+            self.add(evaluation)
+
+    def add(self, evaluation, key=None):
+        """
+        Merge an evaluation into the results, unless it's already included. Returns whether
+        it was added.
+        """
+        key = key or evaluation.get("key")
+        if key is not None and key in self._keys:
+            return False
+        setting = self._get_setting(evaluation)
+        game_id = json.dumps([evaluation["description"], evaluation["info"]["moves"]])
+        game = self._games.get(game_id) or self._add_game(game_id, evaluation)
+        if key is not None:
+            self._keys.add(key)
+        if setting in game["settings"]:
+            return False
+
+        game["settings"].append(setting)
+        for entry, moves in zip(game["plies"], self._get_ranked_moves(evaluation)):
+            if moves:
+                self._merge_ply(entry, setting, moves)
+        return True
+
+    def has_key(self, key):
+        return key in self._keys
+
+    def get_settings(self):
+        return sorted(self._evaluated, key=self._get_order)
+
+    def _add_game(self, game_id, evaluation):
+        pgn_game = chess.pgn.read_game(io.StringIO(evaluation["pgn"]))
+        board = pgn_game.board()
+        plies = []
+        for move in pgn_game.mainline_moves():
+            plies.append(
+                {
+                    "move": move.uci(),
+                    "player": evaluation["info"]["white" if board.turn else "black"],
+                    "top_moves": {},
+                    "top_1_discovery": None,
+                    "top_n_discovery": None,
+                }
+            )
+            board.push(move)
+        game = {
+            "description": evaluation["description"],
+            "settings": [],
+            "plies": plies,
+        }
+        self._games[game_id] = game
+        return game
+
+    def _merge_ply(self, entry, setting, moves):
+        move = entry["move"]
+        for counter in (self._evaluated, self._played_top_1, self._played_top_n):
+            counter.setdefault(setting, 0)
+        self._evaluated[setting] += 1
+        self._played_top_1[setting] += moves[0] == move
+        self._played_top_n[setting] += move in moves[: self._top_n]
+
+        # agreement with every setting already merged for this ply, both ways
+        self._count_agreement(setting, setting, True)
+        for other, other_move in entry["top_moves"].items():
+            self._count_agreement(setting, other, moves[0] == other_move)
+            self._count_agreement(other, setting, moves[0] == other_move)
+
+        stats = self._players.setdefault(
+            entry["player"], {"moves": 0, "top_1_discovery": {}, "top_n_discovery": {}}
+        )
+        first = not entry["top_moves"]
+        entry["top_moves"][setting] = moves[0]
+        stats["moves"] += first
+
+        # discovery is the weakest setting finding the move, a stronger one changes nothing
+        for kind, found in (
+            ("top_1_discovery", moves[0] == move),
+            ("top_n_discovery", move in moves[: self._top_n]),
+        ):
+            current = entry[kind]
+            if found and (
+                current is None or self._get_order(setting) < self._get_order(current)
+            ):
+                entry[kind] = setting
+            if first:
+                self._count_discovery(stats[kind], entry[kind], 1)
+            elif entry[kind] != current:
+                self._count_discovery(stats[kind], current, -1)
+                self._count_discovery(stats[kind], entry[kind], 1)
+
+    def _count_agreement(self, a, b, agree):
+        self._both.setdefault(a, {})[b] = self._both.get(a, {}).get(b, 0) + 1
+        self._agree.setdefault(a, {})[b] = self._agree.get(a, {}).get(b, 0) + agree
+
+    def _count_discovery(self, counts, label, step):
+        label = label or "never"
+        counts[label] = counts.get(label, 0) + step
+        if counts[label] == 0:
+            del counts[label]
+
+    def compare(self):
+        # weakest first: by version, then node budget
+        labels = self.get_settings()
+        games = [
+            {
+                "description": game["description"],
+                "plies": [
+                    {
+                        "ply": ply + 1,
+                        "move": entry["move"],
+                        "top_moves": [entry["top_moves"].get(l) for l in labels],
+                        "top_1_discovery": entry["top_1_discovery"],
+                        "top_n_discovery": entry["top_n_discovery"],
+                    }
+                    for ply, entry in enumerate(game["plies"])
+                ],
+            }
+            for game in self._games.values()
+        ]
+
+        return json.dumps(
+            {
+                "settings": labels,
+                "top_n": self._top_n,
+                "agreement": {
+                    "top_1": {
+                        a: {
+                            b: self._rate(
+                                self._agree.get(a, {}).get(b, 0),
+                                self._both.get(a, {}).get(b, 0),
+                            )
+                            for b in labels
+                        }
+                        for a in labels
+                    },
+                    "played_top_1": {
+                        a: self._rate(self._played_top_1[a], self._evaluated[a])
+                        for a in labels
+                    },
+                    "played_top_n": {
+                        a: self._rate(self._played_top_n[a], self._evaluated[a])
+                        for a in labels
+                    },
+                },
+                "players": self._players,
+                "games": games,
+            }
+        )
+
+    def get_state(self):
+        return {
+            "top_n": self._top_n,
+            "keys": sorted(self._keys),
+            "games": self._games,
+            "evaluated": self._evaluated,
+            "played_top_1": self._played_top_1,
+            "played_top_n": self._played_top_n,
+            "agree": self._agree,
+            "both": self._both,
+            "players": self._players,
+        }
+
+    def _set_state(self, state):
+        self._top_n = state["top_n"]
+        self._keys = set(state["keys"])
+        self._games = state["games"]
+        self._evaluated = state["evaluated"]
+        self._played_top_1 = state["played_top_1"]
+        self._played_top_n = state["played_top_n"]
+        self._agree = state["agree"]
+        self._both = state["both"]
+        self._players = state["players"]
+
+    def _get_ranked_moves(self, evaluation):
+        if evaluation is None:
+            return None
+        rows = []
+        for position in evaluation["evaluation"]:
+            # raw output holds every iteration, deepest first: keep the final one
+            lines = [
+                line
+                for line in position["evaluation"]
+                if line.get("Nodes") == position["evaluation"][0].get("Nodes")
+            ]
+            lines.sort(key=lambda line: int(line["MultiPVLine"] or 1))
+            rows.append([line["Move"] for line in lines])
+        return rows
+
+    def _get_setting(self, evaluation):
+        num_nodes = evaluation["num_nodes"]
+        if isinstance(num_nodes, list):
+            # records stored before they held their own node budget
+            if len(num_nodes) != 1:
+                raise ValueError("Node budget of evaluation is ambiguous", num_nodes)
+            num_nodes = num_nodes[0]
+        return "{}@{}".format(
+            evaluation["engine"]["version"], StockfishVariant.parse_num_nodes(num_nodes)
+        )
+
+    @staticmethod
+    def _get_order(setting):
+        version, num_nodes = setting.split("@")
+        return int(version), int(num_nodes)
+
+    def _rate(self, count, total):
+        return round(count / total, 3) if total else None
+
+
 class RedisStore:
     """
     Class for Redis store, used by Evaluation to store and retrieve results.
-    Faster and safer than writing to file.
+    Faster and safer than writing to file. Connections are pooled per server and db,
+    and shared by all stores in the process.
     """
 
+    # written to by Evaluation and Analysis, see Archive
+    read_only = False
+    _pools = {}
+    _pools_lock = threading.Lock()
+
     def __init__(
         self, host="localhost", port=6379, db=1, connect=True, log_level="info"
     ):
@@ -770,85 +1603,1512 @@ class RedisStore:
 
     def connect(self):
         self._logger.info("Connecting to Redis", self._host, self._port, self._db)
-        self._store = redis.Redis(host=self._host, port=self._port, db=self._db)
+        with self._pools_lock:
+            pool = self._pools.get((self._host, self._port, self._db))
+            if pool is None:
+                pool = redis.ConnectionPool(
+                    host=self._host, port=self._port, db=self._db
+                )
+                self._pools[(self._host, self._port, self._db)] = pool
+        self._store = redis.Redis(connection_pool=pool)
 
+    @Profiler.stage("store")
     def get(self, key):
         self._logger.debug("Getting key", key)
         value = self._store.get(key)
         if value:
             return self.loads(value)
 
+    @Profiler.stage("store")
+    def mget(self, keys):
+        """
+        Get several keys in one round trip, with None for missing keys.
+        """
+        if not keys:
+            return []
+        return [
+            self.loads(value) if value else None for value in self._store.mget(keys)
+        ]
+
+    @Profiler.stage("json")
     def loads(self, value):
         try:
             return json.loads(value)
         except:
             return value
 
-    def set(self, key, value):
+    @Profiler.stage("store")
+    def set(self, key, value, ttl=None):
+        # with ttl, the key expires after that many seconds
         self._logger.debug("Setting key", key)
-        return self._store.set(key, self.dumps(value))
+        return self._store.set(key, self.dumps(value), ex=ttl)
 
+    @Profiler.stage("json")
     def dumps(self, value):
         try:
             return json.dumps(value)
         except:
             return value
 
+    def sadd(self, key, *values):
+        self._logger.debug("Adding to set", key)
+        return self._store.sadd(key, *values)
 
-class Evaluation:
-    """
-    Class for making an evaluation of whole games. Takes Games, returns statistics.
+    def smembers(self, key):
+        return {self._decode(value) for value in self._store.smembers(key)}
 
-    """
+    def srem(self, key, *values):
+        return self._store.srem(key, *values)
 
-    def __init__(
-        self,
-        games=None,
-        stockfish_versions=[9, 10, 11, 12, 13, 14, 15],
-        historical=True,
-        log_level="info",
-        threads=196,
-        hash=4096,
-        depth=20,
-        multi_pv=3,
-        num_nodes=["1M", "10M"],
-        mode="nodes",
-        include_info=True,
-        redis_host="localhost",
-        redis_port=6379,
-        redis_db=1,
-        engine_log_file=None,
-        raw_output=False,
-    ):
-        self._stockfish_variant = None
-        self._evaluations = []
-        self._game_results_store_keys = []
-        self._results = []
-        self._restarts = 0
-        self._crashes = 0
-        self._game = None
-        self._games = games
-        self._stockfish_versions = stockfish_versions
-        self._historical = historical
-        self._threads = threads
-        self._hash = hash
-        self._depth = depth
-        self._multi_pv = multi_pv
-        self._num_nodes = num_nodes
-        self._mode = mode
-        self._include_info = include_info
-        self._engine_log_file = engine_log_file
-        self._raw_output = raw_output
+    def sinter(self, *keys):
+        return {self._decode(value) for value in self._store.sinter(*keys)}
 
-        self._log_level = log_level
-        self._logger = Logger(level=self._log_level)
-        self._logger.info("Initiated")
+    def sismember(self, key, value):
+        return bool(self._store.sismember(key, value))
 
-        self._store = RedisStore(
-            host=redis_host, port=redis_port, db=redis_db, log_level=self._log_level
-        )
+    @Profiler.stage("store")
+    def exists(self, key):
+        return self._store.exists(key) > 0
 
-    def evaluate(self):
+    def scan_iter(self, match="*", count=1000):
+        for key in self._store.scan_iter(match=match, count=count):
+            yield self._decode(key)
+
+    def delete(self, *keys):
+        return self._store.delete(*keys)
+
+    def lpush(self, key, *values):
+        return self._store.lpush(key, *values)
+
+    def llen(self, key):
+        return self._store.llen(key)
+
+    def lrem(self, key, value):
+        return self._store.lrem(key, 0, value)
+
+    def hset(self, key, field, value):
+        return self._store.hset(key, field, self.dumps(value))
+
+    def hget(self, key, field):
+        value = self._store.hget(key, field)
+        if value:
+            return self.loads(value)
+
+    def hdel(self, key, field):
+        return self._store.hdel(key, field)
+
+    def zadd(self, key, mapping):
+        return self._store.zadd(key, mapping)
+
+    def zrem(self, key, *members):
+        return self._store.zrem(key, *members)
+
+    def zrangebyscore(self, key, min, max):
+        return [self._decode(m) for m in self._store.zrangebyscore(key, min, max)]
+
+    def zcard(self, key):
+        return self._store.zcard(key)
+
+    _pop_lease_script = """
+        local member = redis.call('RPOP', KEYS[1])
+        if member then
+            redis.call('ZADD', KEYS[2], ARGV[1], member)
+        end
+        return member
+    """
+
+    def pop_lease(self, source, leases, deadline):
+        """
+        Atomically pop a member from the source list into the leases sorted set,
+        scored by deadline. Returns the member, or None if the list is empty.
+        """
+        if not hasattr(self, "_pop_lease"):
+            self._pop_lease = self._store.register_script(self._pop_lease_script)
+        member = self._pop_lease(keys=[source, leases], args=[deadline])
+        return self._decode(member) if member is not None else None
+
+    def _decode(self, value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class MemoryStore(RedisStore):
+    """
+    In-process stand-in for RedisStore, with the same interface. Values are serialized
+    like they would be for Redis, so round trips cost roughly the same in Python.
+    Used for tests and benchmarks, or single-process runs without a Redis server.
+    """
+
+    def __init__(self, connect=True, log_level="info"):
+        super().__init__(connect=connect, log_level=log_level)
+
+    def connect(self):
+        self._logger.debug("Using in-process store")
+        self._store = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    @Profiler.stage("store")
+    def get(self, key):
+        self._logger.debug("Getting key", key)
+        value = self._get(key)
+        if value:
+            return self.loads(value)
+
+    @Profiler.stage("store")
+    def mget(self, keys):
+        values = [self._get(key) for key in keys]
+        return [self.loads(value) if value else None for value in values]
+
+    def _get(self, key):
+        # expired keys are dropped when read, like Redis does lazily
+        if key in self._expires and self._expires[key] <= time.time():
+            with self._lock:
+                self._store.pop(key, None)
+                self._expires.pop(key, None)
+        return self._store.get(key)
+
+    @Profiler.stage("store")
+    def set(self, key, value, ttl=None):
+        self._logger.debug("Setting key", key)
+        with self._lock:
+            self._store[key] = self.dumps(value)
+            if ttl is not None:
+                self._expires[key] = time.time() + ttl
+            else:
+                self._expires.pop(key, None)
+        return True
+
+    def sadd(self, key, *values):
+        self._logger.debug("Adding to set", key)
+        members = self._store.setdefault(key, set())
+        added = len(set(values) - members)
+        members.update(values)
+        return added
+
+    def smembers(self, key):
+        return set(self._store.get(key, set()))
+
+    def sismember(self, key, value):
+        return value in self._store.get(key, set())
+
+    def srem(self, key, *values):
+        with self._lock:
+            members = self._store.get(key, set())
+            removed = len(members & set(values))
+            members.difference_update(values)
+            return removed
+
+    def sinter(self, *keys):
+        with self._lock:
+            members = [self._store.get(key, set()) for key in keys]
+            return set.intersection(*members) if members else set()
+
+    @Profiler.stage("store")
+    def exists(self, key):
+        return self._get(key) is not None
+
+    def scan_iter(self, match="*", count=1000):
+        with self._lock:
+            keys = list(self._store)
+        return (
+            key
+            for key in keys
+            if fnmatch.fnmatchcase(key, match) and self._get(key) is not None
+        )
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._store.pop(key, None) is not None)
+
+    def lpush(self, key, *values):
+        with self._lock:
+            items = self._store.setdefault(key, [])
+            for value in values:
+                items.insert(0, value)
+            return len(items)
+
+    def llen(self, key):
+        return len(self._store.get(key, []))
+
+    def lrem(self, key, value):
+        with self._lock:
+            items = self._store.get(key, [])
+            removed = items.count(value)
+            items[:] = [item for item in items if item != value]
+            return removed
+
+    def hset(self, key, field, value):
+        with self._lock:
+            fields = self._store.setdefault(key, {})
+            added = 0 if field in fields else 1
+            fields[field] = self.dumps(value)
+            return added
+
+    def hget(self, key, field):
+        value = self._store.get(key, {}).get(field)
+        if value:
+            return self.loads(value)
+
+    def hdel(self, key, field):
+        with self._lock:
+            return 1 if self._store.get(key, {}).pop(field, None) is not None else 0
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            members = self._store.setdefault(key, {})
+            added = len(set(mapping) - set(members))
+            members.update(mapping)
+            return added
+
+    def zrem(self, key, *members):
+        with self._lock:
+            scores = self._store.get(key, {})
+            return sum(1 for m in members if scores.pop(m, None) is not None)
+
+    def zrangebyscore(self, key, min, max):
+        with self._lock:
+            scores = self._store.get(key, {})
+            return [
+                m
+                for m, score in sorted(scores.items(), key=lambda i: i[1])
+                if min <= score <= max
+            ]
+
+    def zcard(self, key):
+        return len(self._store.get(key, {}))
+
+    def pop_lease(self, source, leases, deadline):
+        with self._lock:
+            items = self._store.get(source)
+            if not items:
+                return None
+            member = items.pop()
+            self._store.setdefault(leases, {})[member] = deadline
+            return member
+
+
+class Archive:
+    """
+    Append-only archive of store values on disk, for reading evaluations many times without
+    a server. Every export writes a new segment of length-prefixed key/value records, plus an
+    index of key digests sorted for binary search. Readers mmap both, so lookups and scans
+    slice the segments without copying them. Later segments win for keys exported twice.
+    Has the read side of the RedisStore interface, so an Evaluation can read from it.
+    """
+
+    # written to only by export_store and append, not as a cache
+    read_only = True
+    _index_entry = struct.Struct(">16sQ")
+    _length = struct.Struct(">I")
+
+    def __init__(self, path, log_level="info"):
+        self._path = path
+        self._segments = []
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+        self._logger.info("Initiated")
+
+        os.makedirs(self._path, exist_ok=True)
+        self.open()
+
+    def open(self):
+        self.close()
+        # a segment is complete once its index exists, the index is written last
+        for name in sorted(os.listdir(self._path)):
+            if name.startswith("segment-") and name.endswith(".idx"):
+                self._segments.append(self._open_segment(name[: -len(".idx")]))
+        self._logger.debug("Opened", len(self._segments), "segments")
+
+    def close(self):
+        """
+        Unmap the segments. A segment with a view from get_raw still alive stays mapped until
+        the view is released, so release views to free the memory right away.
+        """
+        for segment in self._segments:
+            for name in ("data", "index"):
+                segment[name].release()
+                try:
+                    segment[name + "_map"].close()
+                except BufferError:
+                    # unmapped when the last view is garbage collected
+                    self._logger.debug("Segment still in use", segment["name"])
+                segment[name + "_file"].close()
+        self._segments = []
+
+    def _open_segment(self, name):
+        segment = {"name": name}
+        for part, extension in (("data", ".dat"), ("index", ".idx")):
+            f = open(os.path.join(self._path, name + extension), "rb")
+            segment[part + "_file"] = f
+            segment[part + "_map"] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            segment[part] = memoryview(segment[part + "_map"])
+        segment["count"] = len(segment["index"]) // self._index_entry.size
+        return segment
+
+    def export_store(self, store, prefixes=("position:", "game:"), batch_size=1000):
+        """
+        Write every key with one of the prefixes to a new segment. Returns the number of
+        records written.
+        """
+
+        def records():
+            for prefix in prefixes:
+                batch = []
+                for key in store.scan_iter(match=prefix + "*", count=batch_size):
+                    batch.append(key)
+                    if len(batch) >= batch_size:
+                        yield from zip(batch, store.mget(batch))
+                        batch = []
+                if batch:
+                    yield from zip(batch, store.mget(batch))
+
+        return self.append(records())
+
+    def import_store(self, store):
+        """
+        Write every record of the archive to the store. Returns the number of records.
+        """
+        count = 0
+        for key, value in self.scan():
+            store.set(key, value)
+            count += 1
+        return count
+
+    def append(self, records):
+        """
+        Write (key, value) pairs to a new segment
+        """
+        name = "segment-{:06d}".format(self._get_next_segment_number())
+        data_path = os.path.join(self._path, name + ".dat")
+        index_path = os.path.join(self._path, name + ".idx")
+
+        entries = []
+        offset = 0
+        with open(data_path + ".tmp", "wb") as f:
+            for key, value in records:
+                if value is None:
+                    continue
+                key_bytes = key.encode("utf-8")
+                value_bytes = json.dumps(value).encode("utf-8")
+                f.write(self._length.pack(len(key_bytes)))
+                f.write(key_bytes)
+                f.write(self._length.pack(len(value_bytes)))
+                f.write(value_bytes)
+                entries.append((hashlib.md5(key_bytes).digest(), offset))
+                offset += 2 * self._length.size + len(key_bytes) + len(value_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if not entries:
+            os.remove(data_path + ".tmp")
+            return 0
+
+        entries.sort()
+        with open(index_path + ".tmp", "wb") as f:
+            for entry in entries:
+                f.write(self._index_entry.pack(*entry))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(index_path + ".tmp", index_path)
+        self._segments.append(self._open_segment(name))
+        self._logger.info("Archived", len(entries), "records to", name)
+        return len(entries)
+
+    def _get_next_segment_number(self):
+        numbers = [
+            int(name[len("segment-") : -len(".idx")])
+            for name in os.listdir(self._path)
+            if name.startswith("segment-") and name.endswith(".idx")
+        ]
+        return max(numbers) + 1 if numbers else 0
+
+    def get_raw(self, key):
+        """
+        Value of a key as a memoryview into the archive, without copying it. The view stays
+        valid after close, see close
+        """
+        digest = hashlib.md5(key.encode("utf-8")).digest()
+        for segment in reversed(self._segments):
+            offset = self._find(segment, digest)
+            if offset is not None:
+                record_key, value, _ = self._read_record(segment["data"], offset)
+                if record_key == key:
+                    return value
+        return None
+
+    def get(self, key):
+        value = self.get_raw(key)
+        if value is not None:
+            return json.loads(value.tobytes())
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def exists(self, key):
+        return self.get_raw(key) is not None
+
+    def scan_iter(self, match="*", count=None):
+        for key, _ in self._scan_raw():
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+    def scan(self, prefix=""):
+        """
+        Sequentially read (key, value) pairs, newest segment first
+        """
+        for key, value in self._scan_raw():
+            if key.startswith(prefix):
+                yield key, json.loads(value.tobytes())
+
+    def _scan_raw(self):
+        seen = set()
+        for segment in reversed(self._segments):
+            data = segment["data"]
+            offset = 0
+            while offset < len(data):
+                key, value, offset = self._read_record(data, offset)
+                if key not in seen:
+                    seen.add(key)
+                    yield key, value
+
+    def _find(self, segment, digest):
+        index, size = segment["index"], self._index_entry.size
+        low, high = 0, segment["count"]
+        while low < high:
+            middle = (low + high) // 2
+            entry_digest, offset = self._index_entry.unpack_from(index, middle * size)
+            if entry_digest < digest:
+                low = middle + 1
+            elif entry_digest > digest:
+                high = middle
+            else:
+                return offset
+        return None
+
+    def _read_record(self, data, offset):
+        (key_length,) = self._length.unpack_from(data, offset)
+        offset += self._length.size
+        key = data[offset : offset + key_length].tobytes().decode("utf-8")
+        offset += key_length
+        (value_length,) = self._length.unpack_from(data, offset)
+        offset += self._length.size
+        return key, data[offset : offset + value_length], offset + value_length
+
+
+class GameIndex:
+    """
+    Secondary indexes over stored games, kept up to date as games are saved: sets of game keys
+    per player, event, engine version, node budget and both, and a sorted set by game date.
+    Queries intersect them in the store, without reading any game records. Games stored
+    before the indexes existed are added by reindex.
+    """
+
+    def __init__(self, store, log_level="info"):
+        self._store = store
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+
+    def add(self, key, game, version, num_nodes, settings_id=None):
+        info = game.get_info()
+        index_keys = [
+            self._player_key(info["white"]),
+            self._player_key(info["black"]),
+            self._event_key(info["event"]),
+            self._engine_key(version),
+            self._engine_key(version, num_nodes),
+            self._nodes_key(num_nodes),
+        ]
+        for index_key in index_keys:
+            if index_key is not None:
+                self._store.sadd(index_key, key)
+
+        date = game.get_date()
+        if date is not None:
+            self._store.zadd("index:date", {key: self._date_score(date)})
+        if settings_id is not None:
+            self._store.sadd(
+                "index:fingerprints:" + settings_id, game.get_fingerprint()
+            )
+        self._logger.debug("Indexed", key)
+
+    def reindex(self, batch_size=500):
+        """
+        Index every stored game record again, eg. games stored before the indexes existed.
+        Returns the number of games indexed.
+        """
+        count = 0
+        keys = list(self._store.scan_iter(match="game:*", count=batch_size))
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i : i + batch_size]
+            for key, record in zip(batch, self._store.mget(batch)):
+                if record is None:
+                    continue
+                num_nodes = record["num_nodes"]
+                if isinstance(num_nodes, list):
+                    # records stored before they held their own node budget
+                    num_nodes = num_nodes[0] if len(num_nodes) == 1 else None
+                game = Game(
+                    game=chess.pgn.read_game(io.StringIO(record["pgn"])),
+                    log_level="none",
+                )
+                if not game.is_valid():
+                    continue
+                self.add(key, game, record["engine"]["version"], num_nodes)
+                count += 1
+        self._logger.info("Reindexed", count, "games")
+        return count
+
+    def has_fingerprint(self, fingerprint, settings_ids):
+        """
+        Whether a game with this fingerprint was stored before with every one of the settings,
+        see Game.get_fingerprint and Evaluation.get_settings_ids
+        """
+        return bool(settings_ids) and all(
+            self._store.sismember("index:fingerprints:" + settings_id, fingerprint)
+            for settings_id in settings_ids
+        )
+
+    def find(
+        self,
+        player=None,
+        event=None,
+        version=None,
+        num_nodes=None,
+        date_from=None,
+        date_to=None,
+    ):
+        """
+        Keys of the games matching every given filter. Dates are datetimes or PGN dates like
+        2022.01.31, both inclusive.
+        """
+        index_keys = []
+        if player is not None:
+            index_keys.append(self._player_key(player))
+        if event is not None:
+            index_keys.append(self._event_key(event))
+        if version is not None:
+            index_keys.append(self._engine_key(version, num_nodes))
+        elif num_nodes is not None:
+            index_keys.append(self._nodes_key(num_nodes))
+
+        keys = self._store.sinter(*index_keys) if index_keys else None
+        if date_from is not None or date_to is not None:
+            dated = set(
+                self._store.zrangebyscore(
+                    "index:date",
+                    self._date_score(date_from) if date_from else 0,
+                    self._date_score(date_to) if date_to else 99999999,
+                )
+            )
+            keys = dated if keys is None else keys & dated
+        if keys is None:
+            raise ValueError("No filter given")
+        return sorted(keys)
+
+    def _player_key(self, player):
+        return "index:player:" + pydash.strings.slugify(player) if player else None
+
+    def _event_key(self, event):
+        return "index:event:" + pydash.strings.slugify(event) if event else None
+
+    def _engine_key(self, version, num_nodes=None):
+        if num_nodes is None:
+            return "index:engine:{}".format(version)
+        return "index:engine:{}:{}".format(
+            version, StockfishVariant.parse_num_nodes(num_nodes)
+        )
+
+    def _nodes_key(self, num_nodes):
+        if num_nodes is None:
+            return None
+        return "index:nodes:{}".format(StockfishVariant.parse_num_nodes(num_nodes))
+
+    def _date_score(self, date):
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime.strptime(date.replace("-", "."), "%Y.%m.%d")
+        return int(date.strftime("%Y%m%d"))
+
+
+class Telemetry:
+    """
+    Per-position search telemetry, aggregated per engine version, thread count and node budget.
+    Splits wall time into engine, store and Python overhead, and keeps nodes, nodes/s and hashfull
+    as reported by the engine. Exported as JSON or in Prometheus text format.
+    """
+
+    _metrics = [
+        ("positions_total", "counter", "Positions processed"),
+        ("cache_hits_total", "counter", "Positions answered from the position cache"),
+        ("searches_total", "counter", "Engine searches run"),
+        ("quarantined_total", "counter", "Positions skipped as quarantined"),
+        ("nodes_total", "counter", "Nodes searched by the engine"),
+        ("early_stops_total", "counter", "Searches stopped before their node budget"),
+        (
+            "widened_searches_total",
+            "counter",
+            "Searches repeated with the full MultiPV",
+        ),
+        ("wall_seconds_total", "counter", "Wall time spent per position"),
+        ("engine_seconds_total", "counter", "Wall time spent in the engine"),
+        ("store_seconds_total", "counter", "Wall time spent in the store"),
+        ("overhead_seconds_total", "counter", "Wall time spent in Python"),
+        ("nodes_per_second", "gauge", "Nodes searched per second of engine wall time"),
+        ("engine_nodes_per_second", "gauge", "Average nodes/s reported by the engine"),
+        ("hashfull_average", "gauge", "Average hashfull (permille) at end of search"),
+        ("hashfull_max", "gauge", "Maximum hashfull (permille) at end of search"),
+    ]
+
+    def __init__(self):
+        self._aggregates = {}
+        self._current = None
+
+    def start_position(self):
+        self._current = {"started": time.perf_counter(), "engine": 0.0, "store": 0.0}
+
+    @contextlib.contextmanager
+    def timer(self, kind):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._current is not None:
+                self._current[kind] += time.perf_counter() - started
+
+    def end_position(
+        self, version, threads, num_nodes, search_info=None, quarantined=False
+    ):
+        if self._current is None:
+            return
+        wall = time.perf_counter() - self._current["started"]
+        engine, store = self._current["engine"], self._current["store"]
+        self._current = None
+
+        key = (version, threads, num_nodes)
+        a = self._aggregates.setdefault(
+            key,
+            {
+                "positions_total": 0,
+                "cache_hits_total": 0,
+                "searches_total": 0,
+                "quarantined_total": 0,
+                "nodes_total": 0,
+                "early_stops_total": 0,
+                "widened_searches_total": 0,
+                "wall_seconds_total": 0.0,
+                "engine_seconds_total": 0.0,
+                "store_seconds_total": 0.0,
+                "overhead_seconds_total": 0.0,
+                "search_seconds_total": 0.0,
+                "engine_nps_total": 0,
+                "hashfull_total": 0,
+                "hashfull_max": 0,
+            },
+        )
+        a["positions_total"] += 1
+        a["wall_seconds_total"] += wall
+        a["engine_seconds_total"] += engine
+        a["store_seconds_total"] += store
+        a["overhead_seconds_total"] += max(wall - engine - store, 0.0)
+        if quarantined:
+            a["quarantined_total"] += 1
+        elif search_info is None:
+            a["cache_hits_total"] += 1
+        else:
+            a["searches_total"] += 1
+            a["nodes_total"] += search_info["nodes"]
+            a["early_stops_total"] += 1 if search_info.get("stopped_early") else 0
+            a["widened_searches_total"] += 1 if search_info.get("widened") else 0
+            a["search_seconds_total"] += search_info["wall_time"]
+            a["engine_nps_total"] += search_info["nps"]
+            a["hashfull_total"] += search_info["hashfull"]
+            a["hashfull_max"] = max(a["hashfull_max"], search_info["hashfull"])
+
+    def get_summary(self):
+        summary = []
+        for (version, threads, num_nodes), a in self._aggregates.items():
+            searches = a["searches_total"]
+            summary.append(
+                {
+                    "version": version,
+                    "threads": threads,
+                    "num_nodes": num_nodes,
+                    "positions_total": a["positions_total"],
+                    "cache_hits_total": a["cache_hits_total"],
+                    "searches_total": searches,
+                    "quarantined_total": a["quarantined_total"],
+                    "nodes_total": a["nodes_total"],
+                    "early_stops_total": a["early_stops_total"],
+                    "widened_searches_total": a["widened_searches_total"],
+                    "wall_seconds_total": round(a["wall_seconds_total"], 4),
+                    "engine_seconds_total": round(a["engine_seconds_total"], 4),
+                    "store_seconds_total": round(a["store_seconds_total"], 4),
+                    "overhead_seconds_total": round(a["overhead_seconds_total"], 4),
+                    "nodes_per_second": round(
+                        a["nodes_total"] / a["search_seconds_total"]
+                    )
+                    if a["search_seconds_total"] > 0
+                    else None,
+                    "engine_nodes_per_second": round(a["engine_nps_total"] / searches)
+                    if searches
+                    else None,
+                    "hashfull_average": round(a["hashfull_total"] / searches, 1)
+                    if searches
+                    else None,
+                    "hashfull_max": a["hashfull_max"] if searches else None,
+                }
+            )
+        return summary
+
+    def to_prometheus(self):
+        summary = self.get_summary()
+        lines = []
+        for name, kind, description in self._metrics:
+            lines.append("# HELP catchfish_{} {}".format(name, description))
+            lines.append("# TYPE catchfish_{} {}".format(name, kind))
+            for item in summary:
+                if item[name] is None:
+                    continue
+                lines.append(
+                    'catchfish_{}{{version="{}",threads="{}",num_nodes="{}"}} {}'.format(
+                        name,
+                        item["version"],
+                        item["threads"],
+                        item["num_nodes"],
+                        item[name],
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """
+        Write metrics to path, in Prometheus text format if path ends with .prom, else JSON.
+        """
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                f.write(json.dumps(self.get_summary(), indent=2))
+        return path
+
+
+class Progress:
+    """
+    Progress and ETA of an evaluation run. Planned work is positions x versions x node budgets,
+    weighted by node budget; cache hits are taken out of the plan as they are found. ETA is based
+    on the measured rate of planned nodes completed per second. Logs to console, and optionally
+    writes a JSON status file that other processes can poll.
+    """
+
+    def __init__(self, status_file=None, interval=10, log_level="info"):
+        self._status_file = status_file
+        self._interval = interval
+        self._positions_total = 0
+        self._nodes_total = 0
+        self._positions_done = 0
+        self._nodes_done = 0
+        self._cache_hits = 0
+        self._nodes_cached = 0
+        self._quarantined = 0
+        self._nodes_searched = 0
+        self._search_seconds = 0.0
+        self._started = None
+        self._last_report = 0
+        self._current = {}
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+
+    def plan(self, positions, nodes):
+        self._positions_total += positions
+        self._nodes_total += nodes
+
+    def start(self):
+        self._started = time.time()
+        self._last_report = self._started
+        self._report(state="running")
+
+    def set_current(self, **current):
+        self._current.update(current)
+
+    def update(self, budget_nodes, search_info=None, positions=1, quarantined=False):
+        """
+        Count one position with the given node budget as done. Without search_info,
+        the position was a cache hit; positions counts several cache hits at once.
+        Quarantined positions are done, without a search.
+        """
+        if quarantined:
+            self._quarantined += 1
+            self._positions_done += 1
+            self._nodes_done += budget_nodes
+        elif search_info is None:
+            self._cache_hits += positions
+            self._nodes_cached += budget_nodes * positions
+        else:
+            self._positions_done += 1
+            self._nodes_done += budget_nodes
+            self._nodes_searched += search_info["nodes"]
+            self._search_seconds += search_info["wall_time"]
+
+        if time.time() - self._last_report >= self._interval:
+            self._report(state="running")
+
+    def set_done(self, positions, nodes):
+        """
+        Set positions and planned nodes done, for work counted elsewhere (eg. by workers).
+        """
+        self._positions_done = positions
+        self._nodes_done = nodes
+
+        if time.time() - self._last_report >= self._interval:
+            self._report(state="running")
+
+    def finish(self):
+        self._report(state="finished")
+
+    def get_status(self):
+        now = time.time()
+        elapsed = now - self._started if self._started else 0
+        planned_nodes = self._nodes_total - self._nodes_cached
+        planned_positions = self._positions_total - self._cache_hits
+        remaining_nodes = max(planned_nodes - self._nodes_done, 0)
+        rate = self._nodes_done / elapsed if elapsed > 0 else 0
+        eta = remaining_nodes / rate if rate > 0 else None
+        return {
+            "started": self._started,
+            "updated": now,
+            "elapsed_seconds": round(elapsed, 1),
+            "percent": round(100.0 * self._nodes_done / planned_nodes, 2)
+            if planned_nodes > 0
+            else 100.0,
+            "positions_done": self._positions_done,
+            "positions_total": planned_positions,
+            "cache_hits": self._cache_hits,
+            "quarantined": self._quarantined,
+            "nodes_done": self._nodes_done,
+            "nodes_total": planned_nodes,
+            "positions_per_second": round(self._positions_done / elapsed, 2)
+            if elapsed > 0
+            else None,
+            "nodes_per_second": round(self._nodes_searched / self._search_seconds)
+            if self._search_seconds > 0
+            else None,
+            "eta_seconds": round(eta) if eta is not None else None,
+            "current": self._current,
+        }
+
+    def _report(self, state):
+        self._last_report = time.time()
+        status = self.get_status()
+        status["state"] = state
+
+        self._logger.info(
+            "Progress: {}% | {}/{} positions | {} cache hits | {} nodes/s | ETA {}".format(
+                status["percent"],
+                status["positions_done"],
+                status["positions_total"],
+                status["cache_hits"],
+                status["nodes_per_second"],
+                self._format_seconds(status["eta_seconds"]),
+            )
+        )
+
+        if self._status_file:
+            tmp_file = self._status_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                f.write(json.dumps(status))
+            os.replace(tmp_file, self._status_file)
+
+    def _format_seconds(self, seconds):
+        if seconds is None:
+            return "unknown"
+        return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class Tuner:
+    """
+    Class for finding the Threads/Hash/process layout with the best throughput on this host.
+    Benchmarks a sample of positions from Games across layouts, optionally pinning each
+    engine process to its own CPUs, and recommends the layout with the most positions per hour.
+    """
+
+    def __init__(
+        self,
+        games=None,
+        stockfish_version=15,
+        num_nodes="30M",
+        multi_pv=3,
+        sample_size=20,
+        layouts=None,
+        hash_sizes=[1024],
+        cpu_count=None,
+        pin=True,
+        binaries_folder=None,
+        log_level="info",
+    ):
+        self._games = games
+        self._stockfish_version = stockfish_version
+        self._num_nodes = num_nodes
+        self._multi_pv = multi_pv
+        self._sample_size = sample_size
+        self._hash_sizes = hash_sizes
+        # CPUs this process may run on, all of them where that isn't known (macOS, Windows)
+        cpus = (
+            os.sched_getaffinity(0)
+            if hasattr(os, "sched_getaffinity")
+            else range(os.cpu_count())
+        )
+        self._cpus = sorted(cpus)[: cpu_count or os.cpu_count()]
+        self._pin = pin and hasattr(os, "sched_setaffinity")
+        self._binaries_folder = binaries_folder
+        self._layouts = layouts or self._get_default_layouts()
+        self._results = []
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+        self._logger.info("Initiated")
+
+    def _get_default_layouts(self):
+        # from one wide engine to one engine per core, splitting total hash between processes
+        layouts = []
+        processes = 1
+        while processes <= len(self._cpus):
+            for hash_size in self._hash_sizes:
+                layouts.append(
+                    {
+                        "processes": processes,
+                        "threads": len(self._cpus) // processes,
+                        "hash": max(hash_size // processes, 1),
+                    }
+                )
+            processes *= 2
+        return layouts
+
+    def get_sample(self):
+        positions = [
+            position
+            for game in self._games.get_games()
+            for position in game.get_positions()
+        ]
+        step = max(len(positions) // self._sample_size, 1)
+        return positions[::step][: self._sample_size]
+
+    def tune(self):
+        sample = self.get_sample()
+        self._logger.info(
+            "Tuning", len(self._layouts), "layouts on", len(sample), "positions."
+        )
+        self._results = []
+        for layout in self._layouts:
+            result = dict(layout)
+            result.update(self._run_layout(layout, sample))
+            self._logger.info("Layout", result)
+            self._results.append(result)
+        return self.get_best()
+
+    def _run_layout(self, layout, sample):
+        variants = []
+        for i in range(layout["processes"]):
+            variant = StockfishVariant(
+                version=self._stockfish_version,
+                threads=layout["threads"],
+                hash=layout["hash"],
+                multi_pv=self._multi_pv,
+                binaries_folder=self._binaries_folder,
+                log_level=self._log_level,
+                initiate=True,
+            )
+            variant.set_num_nodes(self._num_nodes)
+            if self._pin:
+                width = len(self._cpus) // layout["processes"]
+                variant.set_affinity(self._cpus[i * width : (i + 1) * width])
+            variants.append(variant)
+
+        def evaluate(i):
+            for fen in sample[i :: layout["processes"]]:
+                variants[i].set_position(fen)
+                variants[i].evaluate_position()
+
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=evaluate, args=(i,)) for i in range(len(variants))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        for variant in variants:
+            variant.quit()
+
+        return {
+            "seconds": round(elapsed, 3),
+            "positions_per_hour": round(len(sample) / elapsed * 3600)
+            if elapsed > 0
+            else None,
+        }
+
+    def get_results(self):
+        return self._results
+
+    def get_best(self):
+        if not self._results:
+            return None
+        best = max(self._results, key=lambda r: r["positions_per_hour"] or 0)
+        return {
+            "processes": best["processes"],
+            "threads": best["threads"],
+            "hash": best["hash"],
+        }
+
+
+class JobQueue:
+    """
+    Reliable job queue in the store, shared by coordinators and workers on any host.
+    Jobs are leased to one worker at a time with a visibility timeout; when a worker dies,
+    its lease expires and the job is requeued for another worker.
+
+    Every job is queued in a lane, by priority class and batch. A lease takes the next job
+    of the highest priority class that has any, so urgent work preempts the rest as soon as
+    a worker finishes its current position. Within a class, batches take turns, the one
+    served longest ago first.
+    """
+
+    priorities = ["interactive", "normal", "batch"]
+
+    def __init__(self, store, name="evaluation", lease_timeout=3600, log_level="info"):
+        self._store = store
+        self._name = name
+        self._lease_timeout = lease_timeout
+        self._leases = "queue:{}:leases".format(name)
+        self._jobs = "queue:{}:jobs".format(name)
+        self._lanes = "queue:{}:lanes".format(name)
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+
+    def enqueue(self, job_id, job, priority="normal", batch="default"):
+        """
+        Queue a job, once until it is acked. A job queued again with a higher priority, eg.
+        a position shared by a game checked interactively, is moved to the new lane.
+        """
+        lane = [priority, batch]
+        if self._store.hset(self._jobs, job_id, job):
+            self._store.hset(self._lanes, job_id, lane)
+            self._push(job_id, lane)
+            return True
+        queued = self._store.hget(self._lanes, job_id)
+        if queued is not None and self.priorities.index(
+            priority
+        ) < self.priorities.index(queued[0]):
+            # only a job still pending is moved, a leased one is already being searched
+            if self._store.lrem(self._get_pending_key(*queued), job_id):
+                self._logger.debug("Moving job", job_id, "to", priority)
+                self._store.hset(self._lanes, job_id, lane)
+                self._push(job_id, lane)
+        return False
+
+    def lease(self):
+        self.requeue_expired()
+        for priority in self.priorities:
+            for batch in self._get_batches(priority):
+                leased = self._lease_from(priority, batch)
+                if leased is not None:
+                    self._store.zadd(
+                        self._get_served_key(priority), {batch: time.time()}
+                    )
+                    return leased
+        return None
+
+    def _lease_from(self, priority, batch):
+        while True:
+            job_id = self._store.pop_lease(
+                self._get_pending_key(priority, batch),
+                self._leases,
+                time.time() + self._lease_timeout,
+            )
+            if job_id is None:
+                return None
+            job = self._store.hget(self._jobs, job_id)
+            if job is not None:
+                return job_id, job
+            self._store.zrem(self._leases, job_id)
+
+    def _get_batches(self, priority):
+        # least recently served first, new batches before all others
+        batches = self._store.smembers(self._get_batches_key(priority))
+        served = self._store.zrangebyscore(
+            self._get_served_key(priority), 0, float("inf")
+        )
+        return sorted(batches - set(served)) + [b for b in served if b in batches]
+
+    def extend(self, job_id):
+        self._store.zadd(self._leases, {job_id: time.time() + self._lease_timeout})
+
+    def ack(self, job_id):
+        self._store.zrem(self._leases, job_id)
+        self._store.hdel(self._jobs, job_id)
+        self._store.hdel(self._lanes, job_id)
+
+    def release(self, job_id, job):
+        # give a leased job back, eg. after an engine crash
+        self._store.hset(self._jobs, job_id, job)
+        if self._store.zrem(self._leases, job_id):
+            self._push(job_id, self._get_lane(job_id))
+
+    def requeue_expired(self):
+        requeued = 0
+        for job_id in self._store.zrangebyscore(self._leases, 0, time.time()):
+            # only the one who removes the lease requeues the job
+            if self._store.zrem(self._leases, job_id):
+                self._logger.info("Lease expired, requeuing job", job_id)
+                self._push(job_id, self._get_lane(job_id))
+                requeued += 1
+        return requeued
+
+    def size(self, batch=None):
+        """
+        Jobs pending or leased, of one batch or of all. Jobs moved to another batch's lane
+        count for that batch.
+        """
+        pending = 0
+        for priority in self.priorities:
+            for b in self._store.smembers(self._get_batches_key(priority)):
+                if batch is None or b == batch:
+                    pending += self._store.llen(self._get_pending_key(priority, b))
+        if batch is None:
+            return pending + self._store.zcard(self._leases)
+        leased = self._store.zrangebyscore(self._leases, 0, float("inf"))
+        return pending + sum(1 for j in leased if self._get_lane(j)[1] == batch)
+
+    def close_batch(self, batch):
+        # forget a batch once its jobs are done
+        for priority in self.priorities:
+            if not self._store.llen(self._get_pending_key(priority, batch)):
+                self._store.srem(self._get_batches_key(priority), batch)
+                self._store.zrem(self._get_served_key(priority), batch)
+
+    def _push(self, job_id, lane):
+        priority, batch = lane
+        self._store.sadd(self._get_batches_key(priority), batch)
+        self._store.lpush(self._get_pending_key(priority, batch), job_id)
+
+    def _get_lane(self, job_id):
+        return self._store.hget(self._lanes, job_id) or ["normal", "default"]
+
+    def _get_pending_key(self, priority, batch):
+        return "queue:{}:pending:{}:{}".format(self._name, priority, batch)
+
+    def _get_batches_key(self, priority):
+        return "queue:{}:batches:{}".format(self._name, priority)
+
+    def _get_served_key(self, priority):
+        return "queue:{}:served:{}".format(self._name, priority)
+
+
+class Worker:
+    """
+    Class for evaluating positions from a JobQueue, on any host sharing the store.
+    Results go to the shared position cache; the coordinating Evaluation assembles the games.
+    With cpus, the engine is pinned to those CPUs, as the Tuner does when benchmarking.
+    """
+
+    def __init__(
+        self,
+        store=None,
+        redis_host="localhost",
+        redis_port=6379,
+        redis_db=1,
+        queue_name="evaluation",
+        lease_timeout=3600,
+        poll_interval=1,
+        max_position_retries=2,
+        retry_backoff=1.0,
+        binaries_folder=None,
+        engine_log_file=None,
+        cpus=None,
+        log_level="info",
+    ):
+        self._stockfish_variant = None
+        self._engine_settings = None
+        self._cpus = cpus
+        self._poll_interval = poll_interval
+        self._max_position_retries = max_position_retries
+        self._retry_backoff = retry_backoff
+        self._binaries_folder = binaries_folder
+        self._engine_log_file = engine_log_file
+        self._lease_timeout = lease_timeout
+        self._jobs_done = 0
+        self._crashes = 0
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+        self._logger.info("Initiated")
+
+        self._store = store or RedisStore(
+            host=redis_host, port=redis_port, db=redis_db, log_level=self._log_level
+        )
+        self._queue = JobQueue(
+            self._store,
+            name=queue_name,
+            lease_timeout=lease_timeout,
+            log_level=self._log_level,
+        )
+
+    def run(self, stop_when_empty=False, max_jobs=None, stop=None):
+        """
+        Process jobs until max_jobs are done, the queue is empty with stop_when_empty, or the
+        stop event is set. The current position is always finished first.
+        """
+        self._logger.info("Waiting for jobs")
+        while max_jobs is None or self._jobs_done < max_jobs:
+            if stop is not None and stop.is_set():
+                break
+            leased = self._queue.lease()
+            if leased is None:
+                if stop_when_empty and self._queue.size() == 0:
+                    break
+                time.sleep(self._poll_interval)
+                continue
+            self._process(*leased)
+
+        if self._stockfish_variant is not None:
+            self._stockfish_variant.quit()
+            self._stockfish_variant = None
+        self._logger.info("Done,", self._jobs_done, "jobs processed")
+        return self._jobs_done
+
+    def _process(self, job_id, job):
+        heartbeat = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job_id, heartbeat)).start()
+        try:
+            if self._store.exists(job["key"]):
+                # already evaluated, eg. by a worker whose lease expired
+                self._queue.ack(job_id)
+                return
+            variant = self._get_stockfish_variant(job["settings"])
+            variant.set_num_nodes(job["num_nodes"])
+            variant.set_position(job["fen"])
+            evaluation = variant.evaluate_position()
+            self._store.set(job["key"], evaluation)
+            self._queue.ack(job_id)
+            self._jobs_done += 1
+        except Exception as e:
+            self._fail(job_id, job, e)
+        finally:
+            heartbeat.set()
+
+    def _fail(self, job_id, job, error):
+        """
+        Give a failed job back with backoff, like Evaluation retries a position. Positions that
+        keep crashing the engine are quarantined; other errors, eg. a missing binary or an
+        unreachable store, don't say anything about the position, so the job is only released.
+        If even that fails, the lease runs out and the job is requeued.
+        """
+        crashed = isinstance(error, stockfish.StockfishException)
+        if crashed:
+            self._logger.info("Stockfish has crashed on job", job_id)
+            self._crashes += 1
+        else:
+            self._logger.info("Job failed", job_id, error)
+        job["attempts"] = job.get("attempts", 0) + 1
+        job["crashes"] = job.get("crashes", 0) + crashed
+        try:
+            if crashed:
+                self._restart_stockfish_variant()
+            if job["crashes"] > self._max_position_retries:
+                self._quarantine(job, error)
+                self._queue.ack(job_id)
+                return
+            time.sleep(self._retry_backoff * 2 ** min(job["attempts"] - 1, 6))
+            self._queue.release(job_id, job)
+        except Exception as e:
+            self._logger.info("Failed to give back job", job_id, e)
+
+    def _restart_stockfish_variant(self):
+        if self._stockfish_variant is None:
+            return
+        try:
+            self._stockfish_variant.restart()
+            self._pin_stockfish_variant()
+        except Exception as sfe:
+            # started again with the next job
+            self._logger.debug("Restart failed:", sfe)
+            self._stockfish_variant = None
+
+    def _heartbeat(self, job_id, done):
+        # keep the lease while a long search is running
+        while not done.wait(self._lease_timeout / 3.0):
+            self._queue.extend(job_id)
+
+    def _quarantine(self, job, error):
+        self._logger.info("Quarantining position", job["fen"])
+        key = "quarantine:" + job["key"].split(":", 1)[1]
+        self._store.set(
+            key,
+            {
+                "position": job["fen"],
+                "settings": job["settings"],
+                "crashes": job["crashes"],
+                "error": str(error),
+                "date": datetime.datetime.now().isoformat(),
+            },
+        )
+        self._store.sadd("quarantine", key)
+
+    def _get_stockfish_variant(self, settings):
+        # reuse the running engine as long as the settings don't change
+        if self._stockfish_variant is not None and settings == self._engine_settings:
+            return self._stockfish_variant
+        if self._stockfish_variant is not None:
+            self._stockfish_variant.quit()
+            self._stockfish_variant = None
+
+        stockfish_variant = StockfishVariant(
+            version=settings["version"],
+            threads=settings["threads"],
+            hash=settings["hash"],
+            depth=settings["depth"],
+            multi_pv=settings["multi_pv"],
+            mode=settings["mode"],
+            log_level=self._log_level,
+            include_info=settings["include_info"],
+            debug_log_file=self._engine_log_file,
+            binaries_folder=self._binaries_folder,
+            initiate=True,
+            raw_output=settings["raw_output"],
+            early_stop=settings.get("early_stop"),
+        )
+        self._stockfish_variant, self._engine_settings = stockfish_variant, settings
+        self._pin_stockfish_variant()
+        return self._stockfish_variant
+
+    def _pin_stockfish_variant(self):
+        # a restarted engine is a new process, so pinning is repeated after every restart
+        if self._cpus:
+            self._stockfish_variant.set_affinity(self._cpus)
+
+
+class Evaluation:
+    """
+    Class for making an evaluation of whole games. Takes Games, returns statistics.
+
+    """
+
+    def __init__(
+        self,
+        games=None,
+        stockfish_versions=[9, 10, 11, 12, 13, 14, 15],
+        historical=True,
+        log_level="info",
+        threads=196,
+        hash=4096,
+        depth=20,
+        multi_pv=3,
+        num_nodes=["1M", "10M"],
+        mode="nodes",
+        include_info=True,
+        redis_host="localhost",
+        redis_port=6379,
+        redis_db=1,
+        engine_log_file=None,
+        raw_output=False,
+        store=None,
+        binaries_folder=None,
+        metrics_file=None,
+        status_file=None,
+        progress_interval=10,
+        max_position_retries=2,
+        retry_backoff=1.0,
+        max_restarts=200,
+        distributed=False,
+        local_workers=0,
+        pin=False,
+        lease_timeout=3600,
+        poll_interval=1,
+        continuous=False,
+        reverse=False,
+        early_stop=None,
+        adaptive_multi_pv=None,
+        priority="normal",
+        batch=None,
+    ):
+        self._stockfish_variant = None
+        self._evaluations = []
+        self._game_results_store_keys = []
+        self._results = []
+        self._restarts = 0
+        self._crashes = 0
+        self._game = None
+        self._games = games
+        self._stockfish_versions = stockfish_versions
+        self._historical = historical
+        self._threads = threads
+        self._hash = hash
+        self._depth = depth
+        self._multi_pv = multi_pv
+        self._num_nodes = num_nodes
+        self._mode = mode
+        self._include_info = include_info
+        self._engine_log_file = engine_log_file
+        self._raw_output = raw_output
+        self._binaries_folder = binaries_folder
+        self._metrics_file = metrics_file
+        self._telemetry = Telemetry()
+        self._max_position_retries = max_position_retries
+        self._retry_backoff = retry_backoff
+        self._max_restarts = max_restarts
+        self._distributed = distributed
+        self._local_workers = local_workers
+        self._pin = pin and hasattr(os, "sched_setaffinity")
+        self._lease_timeout = lease_timeout
+        self._poll_interval = poll_interval
+        self._continuous = continuous
+        self._reverse = reverse
+        self._early_stop = StockfishVariant.parse_early_stop(early_stop)
+        self._adaptive_multi_pv = (
+            adaptive_multi_pv
+            if adaptive_multi_pv and adaptive_multi_pv < multi_pv
+            else None
+        )
+        self._played_move = None
+        self._position_multi_pv = None
+        self._priority = priority
+        self._batch = batch or "{}-{}".format(os.getpid(), os.urandom(4).hex())
+        self._moves = None
+        self._new_game = False
+        self._zobrist = None
+        self._settings_id = None
+
+        self._log_level = log_level
+        self._logger = Logger(level=self._log_level)
+        self._logger.info("Initiated")
+
+        if self._continuous and self._distributed:
+            # workers search single positions, there is no game to keep the hash warm for
+            self._logger.info("Continuous search is not used in distributed mode.")
+            self._continuous = False
+        if self._adaptive_multi_pv and self._distributed:
+            # workers don't know the played move
+            self._logger.info("Adaptive MultiPV is not used in distributed mode.")
+            self._adaptive_multi_pv = None
+
+        self._progress = Progress(
+            status_file=status_file,
+            interval=progress_interval,
+            log_level=self._log_level,
+        )
+
+        self._store = store or RedisStore(
+            host=redis_host, port=redis_port, db=redis_db, log_level=self._log_level
+        )
+        self._index = GameIndex(self._store, log_level=self._log_level)
+
+    def evaluate(self):
         self._logger.info(
             "Running evaluation matrix with",
             self._stockfish_versions,
@@ -857,7 +3117,33 @@ class Evaluation:
             "number of nodes.",
         )
 
-        self._evaluate()
+        self._plan_progress()
+        self._progress.start()
+        if self._distributed:
+            self._evaluate_distributed()
+        else:
+            self._evaluate()
+        self._progress.finish()
+
+        if self._metrics_file:
+            self._telemetry.export(self._metrics_file)
+            self._logger.info("Metrics written to", self._metrics_file)
+
+    def get_telemetry(self):
+        return self._telemetry
+
+    def get_progress(self):
+        return self._progress
+
+    def _plan_progress(self):
+        for stockfish_version in self._stockfish_versions:
+            positions = sum(
+                game.get_positions_count() for game in self.get_games(stockfish_version)
+            )
+            for num_nodes in self._num_nodes:
+                self._progress.plan(
+                    positions, positions * StockfishVariant.parse_num_nodes(num_nodes)
+                )
 
     def _evaluate(self):
         # for each stockfish
@@ -866,30 +3152,226 @@ class Evaluation:
         # for each fen
         for stockfish_version in self._stockfish_versions:
             self._stockfish_version = stockfish_version
+            games = self.get_games(stockfish_version)
+            if not games:
+                self._logger.info("No games for Stockfish version", stockfish_version)
+                continue
             self._logger.info("Using Stockfish version", stockfish_version)
             self._initiate_stockfish_variant(stockfish_version)
             for num_nodes in self._num_nodes:
                 self._current_num_nodes = num_nodes
                 self._logger.debug("Setting", self._current_num_nodes, "nodes.")
 
-                for game in self.get_games():
+                for game in games:
                     self._game = game
+                    if self._skip_stored_game():
+                        continue
+                    self._progress.set_current(
+                        version=stockfish_version,
+                        num_nodes=num_nodes,
+                        game=game.get_info_string(),
+                    )
 
                     self._logger.debug(
                         "Evaluating game",
                         game.get_info_string(),
                     )
 
-                    for position in game.get_positions():
-                        self._fen = position
-                        self._evaluate_position()
-
+                    self._evaluate_game(game)
                     self._save_game_evaluation()
 
         return self._game_results_store_keys
 
-    def get_games(self):
-        return self._games.get_games()
+    @Profiler.stage("evaluate_game")
+    def _evaluate_game(self, game):
+        """
+        Evaluate every position of a game. In continuous mode the engine is given the game as a
+        move sequence and ucinewgame is only sent once per game, so the hash carries over from
+        ply to ply. With reverse the plies are searched from the last to the first, so earlier
+        positions are searched with the later ones already in the hash.
+        """
+        positions = game.get_positions()
+        hashes = game.get_position_hashes()
+        if not self._continuous:
+            moves = game.get_uci_moves() if self._adaptive_multi_pv else []
+            for ply, (position, zobrist) in enumerate(zip(positions, hashes)):
+                self._fen, self._zobrist = position, zobrist
+                self._played_move = moves[ply] if ply < len(moves) else None
+                self._evaluate_position()
+            self._played_move = None
+            return
+
+        moves = game.get_uci_moves()
+        plies = list(range(len(positions)))
+        if self._reverse:
+            plies.reverse()
+
+        self._new_game = True
+        evaluations = {}
+        for ply in plies:
+            self._fen, self._zobrist = positions[ply], hashes[ply]
+            self._moves = moves[:ply]
+            self._played_move = moves[ply] if ply < len(moves) else None
+            self._evaluate_position()
+            evaluations[ply] = self._evaluations.pop()
+        self._moves = None
+        self._played_move = None
+
+        # keep the stored evaluation in game order
+        self._evaluations = [evaluations[ply] for ply in range(len(positions))]
+
+    def _evaluate_distributed(self):
+        """
+        Coordinate evaluation through the store: enqueue every uncached position as a job,
+        let workers (local threads and/or Worker processes on other hosts) fill the position
+        cache, then assemble the game records from it. Jobs are queued as one batch with the
+        given priority, see JobQueue; an interactive check is served before the positions
+        left in a running batch.
+        """
+        queue = JobQueue(
+            self._store, lease_timeout=self._lease_timeout, log_level=self._log_level
+        )
+
+        jobs, job_nodes, keys = 0, 0, []
+        for stockfish_version in self._stockfish_versions:
+            self._stockfish_version = stockfish_version
+            for num_nodes in self._num_nodes:
+                self._current_num_nodes = num_nodes
+                budget = StockfishVariant.parse_num_nodes(num_nodes)
+                for game in self.get_games(stockfish_version):
+                    self._game = game
+                    if self._store.exists(self._gen_game_key()):
+                        self._progress.update(
+                            budget, positions=game.get_positions_count()
+                        )
+                        continue
+                    for position, zobrist in zip(
+                        game.get_positions(), game.get_position_hashes()
+                    ):
+                        self._fen, self._zobrist = position, zobrist
+                        key = self._gen_pos_eval_key()
+                        if self._store.exists(key) or self._is_quarantined():
+                            self._progress.update(budget)
+                            continue
+                        job = {
+                            "key": key,
+                            "fen": position,
+                            "num_nodes": num_nodes,
+                            "settings": self._get_settings(),
+                        }
+                        keys.append(key)
+                        if queue.enqueue(
+                            key, job, priority=self._priority, batch=self._batch
+                        ):
+                            jobs += 1
+                            job_nodes += budget
+        self._logger.info("Enqueued", jobs, "jobs in batch", self._batch)
+
+        workers, stop = [], threading.Event()
+        cpus = sorted(os.sched_getaffinity(0)) if self._pin else []
+        width = len(cpus) // max(self._local_workers, 1)
+        for i in range(self._local_workers):
+            worker = Worker(
+                store=self._store,
+                lease_timeout=self._lease_timeout,
+                poll_interval=self._poll_interval,
+                max_position_retries=self._max_position_retries,
+                retry_backoff=self._retry_backoff,
+                binaries_folder=self._binaries_folder,
+                engine_log_file=self._engine_log_file,
+                cpus=cpus[i * width : (i + 1) * width] or None,
+                log_level=self._log_level,
+            )
+            thread = threading.Thread(target=worker.run, kwargs={"stop": stop})
+            thread.start()
+            workers.append(thread)
+
+        while True:
+            queue.requeue_expired()
+            remaining = queue.size(batch=self._batch)
+            done = max(jobs - remaining, 0)
+            self._progress.set_done(done, job_nodes * done // jobs if jobs else 0)
+            # positions shared with another batch may still be queued or searched there
+            if remaining == 0 and self._positions_done(keys):
+                break
+            time.sleep(self._poll_interval)
+
+        stop.set()
+        for thread in workers:
+            thread.join()
+        queue.close_batch(self._batch)
+
+        self._assemble_game_evaluations()
+        return self._game_results_store_keys
+
+    def _positions_done(self, keys):
+        # drops the keys found, so each key is only read until it's there
+        missing = []
+        for i in range(0, len(keys), 1000):
+            batch = keys[i : i + 1000]
+            for key, value in zip(batch, self._store.mget(batch)):
+                quarantined = "quarantine:" + key.split(":", 1)[1]
+                if value is None and not self._store.exists(quarantined):
+                    missing.append(key)
+        keys[:] = missing
+        return not missing
+
+    def _assemble_game_evaluations(self):
+        for stockfish_version in self._stockfish_versions:
+            self._stockfish_version = stockfish_version
+            self._stockfish_variant = StockfishVariant(
+                version=stockfish_version, log_level=self._log_level
+            )
+            for num_nodes in self._num_nodes:
+                self._current_num_nodes = num_nodes
+                self._stockfish_variant.set_num_nodes(num_nodes)
+                for game in self.get_games(stockfish_version):
+                    self._game = game
+                    key = self._gen_game_key()
+                    if self._store.exists(key):
+                        self._add_result_key(key)
+                        continue
+                    for position, zobrist in zip(
+                        game.get_positions(), game.get_position_hashes()
+                    ):
+                        self._fen, self._zobrist = position, zobrist
+                        key = self._gen_pos_eval_key()
+                        if self._store.exists(key):
+                            self._evaluations.append({"key": key, "position": position})
+                        else:
+                            self._set_position_evaluation([], quarantined=True)
+                    self._save_game_evaluation()
+        self._stockfish_variant = None
+
+    def _skip_stored_game(self):
+        """
+        Skip the current game if it's already stored with these settings, without probing
+        its positions or sending anything to the engine.
+        """
+        key = self._gen_game_key()
+        if not self._store.exists(key):
+            return False
+        self._logger.debug("Game already evaluated:", key)
+        self._add_result_key(key)
+        self._progress.update(
+            StockfishVariant.parse_num_nodes(self._current_num_nodes),
+            positions=self._game.get_positions_count(),
+        )
+        return True
+
+    def get_games(self, stockfish_version=None):
+        """
+        Games to evaluate, with a version given and historical mode on, only the games played
+        after that version was released. Games without a usable date get every version.
+        """
+        games = self._games.get_games()
+        if not self._historical or stockfish_version is None:
+            return games
+        return [
+            game
+            for game in games
+            if StockfishVariant.is_available(stockfish_version, game.get_date())
+        ]
 
     def _initiate_stockfish_variant(self, stockfish_version):
         if self._stockfish_variant is not None:
@@ -905,41 +3387,130 @@ class Evaluation:
             log_level=self._log_level,
             include_info=self._include_info,
             debug_log_file=self._engine_log_file,
+            binaries_folder=self._binaries_folder,
             initiate=True,
             raw_output=self._raw_output,
+            early_stop=self._early_stop,
         )
 
     def _evaluate_position(self):
-        self._stockfish_variant.set_num_nodes(self._current_num_nodes)
-        self._stockfish_variant.set_position(self._fen)
-
-        try:
+        """
+        Evaluate the current position, supervising the engine: a crash restarts the engine and
+        retries the position with backoff, up to max_position_retries. Positions that keep
+        crashing the engine are quarantined, so the rest of the run can go on.
+        """
+        self._position_multi_pv = None
+        self._telemetry.start_position()
+        with self._telemetry.timer("store"):
             exisiting_evaluation = self._get_position_evaluation()
-            if exisiting_evaluation:
-                self._logger.debug(
-                    "Evaluation already exists for position",
-                    self._fen,
-                    "with num_nodes",
-                    self._current_num_nodes,
-                )
-                self._set_position_evaluation(exisiting_evaluation)
-                return
-            else:
-                evaluation = self._stockfish_variant.evaluate_position()
-                self._set_position_evaluation(evaluation)
-        except StockfishException as sfe:
-            self._logger.info("Stockfish has crashed. Fixing...")
+        if exisiting_evaluation:
             self._logger.debug(
-                "Stockfish crash info:",
-                sfe,
-                self._get_settings(),
+                "Evaluation already exists for position",
                 self._fen,
+                "with num_nodes",
+                self._current_num_nodes,
             )
-            self._crashes += 1
-            self._restart_stockfish_after_crash()
+            with self._telemetry.timer("store"):
+                self._set_position_evaluation(exisiting_evaluation, cached=True)
+            self._end_position()
+            return
+
+        # only probed on a cache miss, so a cached position stays at one round trip
+        if self._is_quarantined():
+            self._logger.info("Skipping quarantined position", self._fen)
+            self._set_position_evaluation([], quarantined=True)
+            self._end_position(quarantined=True)
+            return
+
+        multi_pv = self._position_multi_pv
+        for attempt in range(self._max_position_retries + 1):
+            try:
+                self._position_multi_pv = multi_pv
+                self._search_and_set_position()
+                self._restarts = 0
+                return
+            except stockfish.StockfishException as sfe:
+                self._logger.info("Stockfish has crashed. Fixing...")
+                self._logger.debug(
+                    "Stockfish crash info:",
+                    sfe,
+                    self._get_settings(),
+                    self._fen,
+                )
+                self._crashes += 1
+                error = sfe
+                if attempt < self._max_position_retries:
+                    time.sleep(self._retry_backoff * 2**attempt)
+                self._restart_stockfish_after_crash()
+
+        self._quarantine_position(error)
+
+    def _search_and_set_position(self):
+        with self._telemetry.timer("engine"):
+            self._stockfish_variant.set_num_nodes(self._current_num_nodes)
+            self._set_engine_position()
+            evaluation = self._search_position()
+        with self._telemetry.timer("store"):
+            self._set_position_evaluation(evaluation)
+        self._end_position(self._stockfish_variant.get_search_info())
+
+    def _search_position(self):
+        """
+        Search with the MultiPV picked by _get_position_evaluation. When a narrow search misses
+        the played move, its result is cached and the position is searched again with the full
+        MultiPV, so the rank and centipawn loss of the move stay exact. Single positions are set
+        again, which clears the hash; in continuous mode the hash stays warm from the narrow
+        search.
+        """
+        self._stockfish_variant.set_multi_pv(self._position_multi_pv or self._multi_pv)
+        evaluation = self._stockfish_variant.evaluate_position()
+        if self._position_multi_pv is None or not self._misses_played_move(evaluation):
+            return evaluation
+
+        with self._telemetry.timer("store"):
+            self._store.set(self._gen_pos_eval_key(), evaluation)
+        narrow = self._stockfish_variant.get_search_info()
+        self._position_multi_pv = None
+        self._stockfish_variant.set_multi_pv(self._multi_pv)
+        if self._moves is None:
+            self._set_engine_position()
+        evaluation = self._stockfish_variant.evaluate_position()
+
+        info = self._stockfish_variant.get_search_info()
+        for name in ("nodes", "time", "wall_time"):
+            info[name] += narrow[name]
+        info["widened"] = True
+        return evaluation
+
+    def _set_engine_position(self):
+        if self._moves is None:
+            self._stockfish_variant.set_position(self._fen)
+            return
+        self._stockfish_variant.set_moves(
+            self._moves,
+            self._fen,
+            start_fen=self._game.get_start_fen(),
+            new_game=self._new_game,
+        )
+        self._new_game = False
+
+    def _end_position(self, search_info=None, quarantined=False):
+        self._telemetry.end_position(
+            self._stockfish_version,
+            self._threads,
+            self._current_num_nodes,
+            search_info,
+            quarantined=quarantined,
+        )
+        # the engine only gets the budget on a search, so a cache hit reads it from the settings
+        self._progress.update(
+            StockfishVariant.parse_num_nodes(self._current_num_nodes),
+            search_info,
+            quarantined=quarantined,
+        )
 
     def _get_settings(self):
-        return {
+        settings = {
             "threads": self._threads,
             "hash": self._hash,
             "depth": self._depth,
@@ -950,18 +3521,67 @@ class Evaluation:
             "version": self._stockfish_version,
             "raw_output": self._raw_output,
         }
+        # a warm hash changes the results, keep them apart from fresh searches. Only added when
+        # enabled so existing cache keys stay valid
+        if self._continuous:
+            settings["continuous"] = "reverse" if self._reverse else "forward"
+        if self._early_stop is not None:
+            settings["early_stop"] = self._early_stop
+        if self._adaptive_multi_pv is not None:
+            settings["adaptive_multi_pv"] = self._adaptive_multi_pv
+        return settings
 
     def _restart_stockfish_after_crash(self):
         self._logger.info("Restarting Stockfish")
 
-        if self._restarts < 200:
+        # only consecutive restarts count, a successful position resets the counter
+        if self._restarts < self._max_restarts:
             self._restarts += 1
-            self._initiate_stockfish_variant(self._stockfish_version)
-            self._evaluate_position()
+            try:
+                self._stockfish_variant.restart()
+            except stockfish.StockfishException as sfe:
+                self._logger.debug("Restart failed:", sfe)
         else:
-            self._logger.info("Too many restarts. Quitting!")
-            sys.exit(1)
+            # raised instead of exiting, so a library caller or worker can handle it
+            self._logger.info("Too many restarts. Giving up!")
+            raise RuntimeError(
+                "Stockfish crashed {} times in a row".format(self._restarts + 1)
+            )
+
+    def _is_quarantined(self):
+        return self._store.get(self._gen_quarantine_key()) is not None
+
+    def _quarantine_position(self, error):
+        self._logger.info("Quarantining position", self._fen)
+        key = self._gen_quarantine_key()
+        self._store.set(
+            key,
+            {
+                "position": self._fen,
+                "settings": self._get_settings(),
+                "crashes": self._max_position_retries + 1,
+                "error": str(error),
+                "date": datetime.datetime.now().isoformat(),
+            },
+        )
+        self._store.sadd("quarantine", key)
+        self._set_position_evaluation([], quarantined=True)
+        self._end_position(quarantined=True)
+
+    def get_quarantine(self):
+        return [
+            self._store.get(key) for key in sorted(self._store.smembers("quarantine"))
+        ]
+
+    def _gen_quarantine_key(self):
+        # keyed with the full MultiPV, so a position quarantined during a narrow search of
+        # adaptive_multi_pv is found again before the next search
+        position_multi_pv, self._position_multi_pv = self._position_multi_pv, None
+        key = "quarantine:" + self._gen_pos_eval_key().split(":", 1)[1]
+        self._position_multi_pv = position_multi_pv
+        return key
 
+    @Profiler.stage("game_record")
     def _save_game_evaluation(self):
         self._logger.debug("Saving game evaluation.")
         result = {
@@ -969,21 +3589,56 @@ class Evaluation:
             "description": self._game.get_info_string(),
             "evaluation": self._evaluations,
             "engine": self._stockfish_variant.get_long_version(),
-            "num_nodes": self._num_nodes,
+            "num_nodes": self._current_num_nodes,
             "pgn": self._game.get_pgn(headers=True),
         }
-        key = self._write_to_store("game", result)
+        key = self._write_to_store(self._gen_game_key(), result)
         if key:
-            self._game_results_store_keys.append(
-                {"description": result["description"], "key": key}
+            self._add_result_key(key)
+            self._index.add(
+                key,
+                self._game,
+                self._stockfish_version,
+                self._current_num_nodes,
+                settings_id=self._get_game_settings_id(),
             )
 
         self._evaluations = []
 
-    def _write_to_store(self, prefix, data):
-        store_key = (
-            prefix + ":" + hashlib.md5(json.dumps(data).encode("utf-8")).hexdigest()
+    def get_settings_ids(self):
+        """
+        Ids of the settings games are stored with, one per version and node budget
+        """
+        ids = []
+        for version in self._stockfish_versions:
+            for num_nodes in self._num_nodes:
+                self._stockfish_version, self._current_num_nodes = version, num_nodes
+                ids.append(self._get_game_settings_id())
+        return ids
+
+    def _get_game_settings_id(self):
+        settings = dict(self._get_settings(), num_nodes=self._current_num_nodes)
+        return hashlib.md5(json.dumps(settings).encode("utf-8")).hexdigest()[:8]
+
+    def _add_result_key(self, key):
+        self._game_results_store_keys.append(
+            {"description": self._game.get_info_string(), "key": key}
+        )
+
+    def _gen_game_key(self):
+        # from what determines the evaluation, not from the result, so it's known up front
+        settings = dict(self._get_settings(), num_nodes=self._current_num_nodes)
+        game = [
+            self._game.get_start_fen(),
+            self._game.get_uci_moves(),
+            self._game.get_info_string(),
+        ]
+        return (
+            "game:"
+            + hashlib.md5(json.dumps([settings, game]).encode("utf-8")).hexdigest()
         )
+
+    def _write_to_store(self, store_key, data):
         self._logger.debug("Store key:", store_key)
         if self._store.set(store_key, data):
             self._logger.info(
@@ -1007,7 +3662,7 @@ class Evaluation:
     def _write_to_file(self, result):
         file = (
             "/home/ubuntu/catchfish/data/evaluations/"
-            + slugify(self._game.get_info())
+            + pydash.strings.slugify(self._game.get_info())
             + "_"
             + str(self._num_nodes)
             + "_"
@@ -1020,38 +3675,136 @@ class Evaluation:
             gf.close()
 
     def _get_position_evaluation(self):
-        return self._store.get(self._gen_pos_eval_key())
+        """
+        Cached evaluation of the current position. With adaptive_multi_pv, a narrow result is
+        only used when it has the played move, else a full MultiPV result is looked up. On a
+        miss, _position_multi_pv is left at the MultiPV to search with first.
+        """
+        if self._adaptive_multi_pv is None:
+            return self._store.get(self._gen_pos_eval_key())
+        self._position_multi_pv = self._adaptive_multi_pv
+        narrow = self._store.get(self._gen_pos_eval_key())
+        if narrow and not self._misses_played_move(narrow):
+            return narrow
+        self._position_multi_pv = None
+        evaluation = self._store.get(self._gen_pos_eval_key())
+        if not evaluation and not narrow:
+            self._position_multi_pv = self._adaptive_multi_pv
+        return evaluation
+
+    def _misses_played_move(self, evaluation):
+        # only the lines of the final iteration count, as in raw output every iteration is kept
+        if self._played_move is None or not evaluation:
+            return False
+        final = [e for e in evaluation if e["Nodes"] == evaluation[0]["Nodes"]]
+        if len(final) < self._adaptive_multi_pv:
+            # fewer lines than asked for, every legal move is listed
+            return False
+        return self._played_move not in [e["Move"] for e in final]
 
-    def _set_position_evaluation(self, evaluation):
-        self._evaluations.append(
-            {
-                "evaluation": evaluation,
-                "position": self._fen,
-            }
-        )
-        self._store.set(self._gen_pos_eval_key(), evaluation)
+    def _set_position_evaluation(self, evaluation, quarantined=False, cached=False):
+        if quarantined:
+            self._evaluations.append(
+                {"evaluation": evaluation, "position": self._fen, "quarantined": True}
+            )
+            return
+        # game records only reference the position, the evaluation is stored once per position
+        key = self._gen_pos_eval_key()
+        self._evaluations.append({"key": key, "position": self._fen})
+        if not cached:
+            self._store.set(key, evaluation)
 
     def _gen_pos_eval_key(self):
-        return (
-            "position:"
-            + hashlib.md5(
-                json.dumps([self._get_settings(), self._fen]).encode("utf-8")
-            ).hexdigest()
-        )
+        # 64-bit Zobrist hash of the position, under a digest of the settings that is only
+        # recomputed when they change. The FEN travels along in the game record
+        return "position:{}:{:016x}".format(self._get_settings_id(), self._zobrist)
+
+    def _get_settings_id(self):
+        # a position searched with some MultiPV is keyed as if that were the only MultiPV, so
+        # adaptive runs share the cache with plain runs of either width
+        multi_pv = self._position_multi_pv or self._multi_pv
+        current = (self._stockfish_version, self._current_num_nodes, multi_pv)
+        if self._settings_id is None or self._settings_id[0] != current:
+            settings = dict(
+                self._get_settings(),
+                num_nodes=self._current_num_nodes,
+                multi_pv=multi_pv,
+            )
+            settings.pop("adaptive_multi_pv", None)
+            digest = hashlib.md5(json.dumps(settings).encode("utf-8")).hexdigest()
+            self._settings_id = (current, digest[:8])
+        return self._settings_id[1]
 
     def get_results(self):
-        self._results = []
-        for item in self._game_results_store_keys:
-            result = self._read_from_store(item["key"])
-            if result:
-                self._results.append(result)
+        self._results = list(self.get_evaluations(self._game_results_store_keys))
         return self._results
 
+    def get_evaluations(self, keys=None, prefix="game:", batch_size=500):
+        """
+        Yield stored game evaluations, reading batch_size records per round trip, so memory
+        stays bounded however many games are read. keys are store keys or result keys as
+        given by get_result_keys; without keys, every key with the prefix is scanned.
+        """
+        if keys is None:
+            keys = self._store.scan_iter(match=prefix + "*", count=batch_size)
+        batch = []
+        for key in keys:
+            key = key["key"] if isinstance(key, dict) else key
+            if not key.startswith(prefix):
+                continue
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield from self._read_batch(batch)
+                batch = []
+        if batch:
+            yield from self._read_batch(batch)
+
+    def _read_batch(self, keys):
+        self._logger.debug("Reading", len(keys), "store keys")
+        results = []
+        for key, result in zip(keys, self._store.mget(keys)):
+            if result:
+                result["key"] = key
+                results.append(result)
+        return self._resolve_positions(results)
+
     def get_result_keys(self):
         return self._game_results_store_keys
 
+    def find_keys(self, **filters):
+        """
+        Keys of stored games by player, event, version, num_nodes and date range,
+        see GameIndex.find
+        """
+        return self._index.find(**filters)
+
     def get_result_by_key(self, key):
-        return self._read_from_store(key)
+        result = self._read_from_store(key)
+        if result:
+            result["key"] = key
+            self._resolve_positions([result])
+        return result
+
+    def _resolve_positions(self, results, batch_size=1000):
+        """
+        Replace the position references in game records with their evaluations, fetched
+        from the store in batches. Records with inline evaluations are left as they are.
+        """
+        references = [
+            (result["evaluation"], idx)
+            for result in results
+            for idx, item in enumerate(result["evaluation"])
+            if "key" in item
+        ]
+        for start in range(0, len(references), batch_size):
+            batch = references[start : start + batch_size]
+            keys = [evaluations[idx]["key"] for evaluations, idx in batch]
+            for (evaluations, idx), evaluation in zip(batch, self._store.mget(keys)):
+                evaluations[idx] = {
+                    "evaluation": evaluation if evaluation is not None else [],
+                    "position": evaluations[idx]["position"],
+                }
+        return results
 
 
 class Game:
@@ -1082,6 +3835,7 @@ class Game:
     def get_game(self):
         return self._game
 
+    @Profiler.stage("pgn_export")
     def get_pgn(self, headers=False, variations=False, comments=False):
         exporter = chess.pgn.StringExporter(
             headers=headers, variations=variations, comments=comments
@@ -1139,6 +3893,7 @@ class Game:
             + self.get_header("PlyCount")
         )
 
+    @Profiler.stage("board_replay")
     def get_positions(self):
         self._positions = []
         game = self._game
@@ -1156,6 +3911,28 @@ class Game:
                 break
         return self._positions
 
+    def get_uci_moves(self):
+        return [move.uci() for move in self._game.mainline_moves()]
+
+    def get_start_fen(self):
+        return self._game.board().fen()
+
+    @Profiler.stage("board_replay")
+    def get_position_hashes(self):
+        """
+        Polyglot Zobrist hashes of the positions, in the same order as get_positions
+        """
+        board = self._game.board()
+        hashes = []
+        for move in self._game.mainline_moves():
+            hashes.append(chess.polyglot.zobrist_hash(board))
+            board.push(move)
+        return hashes or [chess.polyglot.zobrist_hash(board)]
+
+    def get_positions_count(self):
+        # same count as get_positions, without building boards
+        return max(sum(1 for _ in self._game.mainline_moves()), 1)
+
     def get_moves(self):
         self._logger.debug("Reading moves in game.")
         game = self._game
@@ -1177,6 +3954,7 @@ class Game:
             game = game.next()
         return boards
 
+    @Profiler.stage("board_replay")
     def _validate_game(self, game=None):
         game = game if game else self._game
         try:
@@ -1214,6 +3992,62 @@ class Game:
             self._logger.debug("Error", e)
             return None
 
+    def get_date(self):
+        return self.parse_pgn_date(self.get_header("Date"))
+
+    def get_fingerprint(self):
+        """
+        Identifies a game across PGN sources, which often differ in their headers: the moves,
+        the players' surnames, the date and the round, when known.
+        """
+        fingerprint = [
+            self.get_start_fen(),
+            self.get_uci_moves(),
+            self._normalize_player(self.get_header("White")),
+            self._normalize_player(self.get_header("Black")),
+            self._normalize_header(self.get_header("Date")),
+            self._normalize_header(self.get_header("Round")),
+        ]
+        return hashlib.md5(json.dumps(fingerprint).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize_header(value):
+        # "2022.08.18" and "2022-08-18" are the same date, "?" is no round
+        value = (value or "").strip().replace("-", ".")
+        return value if value.strip("?.") else None
+
+    @staticmethod
+    def _normalize_player(name):
+        # "Carlsen, Magnus", "Carlsen,M." and "Magnus Carlsen" all give "carlsen"
+        if not name or not name.split():
+            return ""
+        surname = name.split(",")[0] if "," in name else name.split()[-1]
+        return "".join(c for c in surname.lower() if c.isalpha())
+
+    @staticmethod
+    def parse_pgn_date(date):
+        """
+        Date the game was played, or None if unknown. Partial dates like 2020.??.?? give
+        the last day they could be, so no engine available at the time is left out.
+        """
+        if not date:
+            return None
+        for date_format in ("%Y.%m.%d", "%Y-%m-%d"):
+            try:
+                return datetime.datetime.strptime(date, date_format)
+            except ValueError:
+                pass
+        parts = date.replace("-", ".").split(".")
+        if not parts[0].isdigit():
+            return None
+        if len(parts) > 1 and parts[1].isdigit():
+            month = int(parts[1])
+            next_month = datetime.datetime(
+                int(parts[0]) + month // 12, month % 12 + 1, 1
+            )
+            return next_month - datetime.timedelta(days=1)
+        return datetime.datetime(int(parts[0]), 12, 31)
+
     def _parse_date(self, date):
         try:
             return datetime.datetime.strptime(date, "%Y.%m.%d")  # YY.MM.DD
@@ -1241,9 +4075,28 @@ class Games:
         log_level="info",
         validate_fen=True,
         limit_games=0,
+        players=None,
+        events=None,
+        date_from=None,
+        date_to=None,
+        min_elo=None,
+        results=None,
+        deduplicate=True,
+        fingerprint_store=None,
+        fingerprint_settings=None,
     ):
         self._games = []
         self._invalid_games = 0
+        self._filtered_games = 0
+        self._duplicate_games = 0
+        self._fingerprints = set()
+        self._deduplicate = deduplicate
+        self._fingerprint_settings = fingerprint_settings
+        self._index = (
+            GameIndex(fingerprint_store, log_level=log_level)
+            if fingerprint_store is not None
+            else None
+        )
         self._headers = {}
         self._pgn = pgn
         self._path = path
@@ -1251,6 +4104,9 @@ class Games:
         self._stockfish = stockfish_variant or StockfishVariant(initiate=True)
         self._validate_fen = validate_fen
         self._limit_games = limit_games if limit_games > 0 else 1000000
+        self._filters = self._get_filters(
+            players, events, date_from, date_to, min_elo, results
+        )
 
         self._log_level = log_level
         self._logger = Logger(level=self._log_level)
@@ -1259,7 +4115,7 @@ class Games:
         self._logger.debug("Games created.")
 
         if pgn is not None:
-            self.add_pgn()
+            self.add_pgn(pgn)
 
         if path is not None:
             self.read_file(path)
@@ -1283,8 +4139,17 @@ class Games:
         self._logger.debug("Ingesting games from PGN")
         while True and not self._limit_reached():
             try:
-                game = chess.pgn.read_game(self._pgn)  # could be many games
-                self.ingest_game(game)
+                seekable = self._pgn.seekable()
+                if self._filters and seekable and not self._skip_to_next_match():
+                    break
+                game = self._read_game()  # could be many games
+                if game is not None and self._filters and not seekable:
+                    # streams can't seek back after the headers, filter parsed games
+                    if not self._matches(game.headers):
+                        self._filtered_games += 1
+                        continue
+                if game is not None:
+                    self.ingest_game(game)
             except KeyboardInterrupt:
                 # quit
                 self._logger.error("Keyboard interrupt. Quitting!")
@@ -1296,12 +4161,110 @@ class Games:
                 break
         self._logger.info("Ingested", len(self._games), "games.")
 
+    @Profiler.stage("pgn_parse")
+    def _read_game(self):
+        return chess.pgn.read_game(self._pgn)
+
+    @Profiler.stage("pgn_parse")
+    def _skip_to_next_match(self):
+        """
+        Skip games not matching the filters by reading only their headers, and leave the
+        PGN at the start of the next matching game. Returns False at the end of the PGN.
+        """
+        while True:
+            offset = self._pgn.tell()
+            headers = chess.pgn.read_headers(self._pgn)
+            if headers is None:
+                return False
+            if self._matches(headers):
+                self._pgn.seek(offset)
+                return True
+            self._filtered_games += 1
+
+    def _matches(self, headers):
+        filters = self._filters
+        if "players" in filters:
+            players = {
+                headers.get("White", "").lower(),
+                headers.get("Black", "").lower(),
+            }
+            if not players & filters["players"]:
+                return False
+        if "events" in filters:
+            if headers.get("Event", "").lower() not in filters["events"]:
+                return False
+        if "results" in filters:
+            if headers.get("Result") not in filters["results"]:
+                return False
+        if "min_elo" in filters:
+            try:
+                elo = min(int(headers["WhiteElo"]), int(headers["BlackElo"]))
+            except (KeyError, ValueError):
+                return False
+            if elo < filters["min_elo"]:
+                return False
+        if "date_from" in filters or "date_to" in filters:
+            date = Game.parse_pgn_date(headers.get("Date"))
+            if date is None:
+                return False
+            if "date_from" in filters and date < filters["date_from"]:
+                return False
+            if "date_to" in filters and date > filters["date_to"]:
+                return False
+        return True
+
+    def _get_filters(self, players, events, date_from, date_to, min_elo, results):
+        filters = {}
+        for name, values in (("players", players), ("events", events)):
+            if values:
+                values = [values] if isinstance(values, str) else values
+                filters[name] = {value.lower() for value in values}
+        for name, date in (("date_from", date_from), ("date_to", date_to)):
+            if date:
+                filters[name] = (
+                    date
+                    if isinstance(date, datetime.datetime)
+                    else Game.parse_pgn_date(date)
+                )
+        if min_elo:
+            filters["min_elo"] = min_elo
+        if results:
+            filters["results"] = [results] if isinstance(results, str) else results
+        return filters
+
+    def get_filtered_games_count(self):
+        return self._filtered_games
+
     def ingest_game(self, game):
         g = Game(game=game, log_level=self._log_level)
-        if g.is_valid():
-            self._games.append(g)
-        else:
+        if not g.is_valid():
             self._invalid_games += 1
+        elif self._is_duplicate(g):
+            self._duplicate_games += 1
+        else:
+            self._games.append(g)
+
+    def _is_duplicate(self, game):
+        """
+        Games seen before in this or an earlier PGN, or with a fingerprint store, games
+        stored by an earlier run with every one of fingerprint_settings.
+        """
+        if not self._deduplicate:
+            return False
+        fingerprint = game.get_fingerprint()
+        if fingerprint in self._fingerprints:
+            self._logger.debug("Duplicate game", game.get_info_string())
+            return True
+        self._fingerprints.add(fingerprint)
+        if self._index is not None and self._index.has_fingerprint(
+            fingerprint, self._fingerprint_settings
+        ):
+            self._logger.debug("Game already stored", game.get_info_string())
+            return True
+        return False
+
+    def get_duplicate_games_count(self):
+        return self._duplicate_games
 
     def get_games(self):
         return self._games
@@ -1359,6 +4322,17 @@ class StockfishVariant:
         "UCI_Elo": 2850,
     }
 
+    # criteria for ending a nodes search before its budget is spent, see _get_early_stop_reason
+    _early_stop_defaults = {
+        "min_nodes": 1000000,
+        "decisive_cp": 1000,
+        "decisive_depths": 5,
+        "stable_depths": 10,
+        "stable_cp": 20,
+        "stable_gap_cp": 100,
+        "only_move": True,
+    }
+
     def __init__(
         self,
         version=15,
@@ -1374,6 +4348,7 @@ class StockfishVariant:
         debug_log_file=None,
         include_info=True,
         raw_output=False,
+        early_stop=None,
     ):
         self._initiated = False
         self._version = version
@@ -1387,6 +4362,9 @@ class StockfishVariant:
         self._debug_log_file = debug_log_file
         self._include_info = include_info
         self._raw_output = raw_output
+        self._early_stop = self.parse_early_stop(early_stop)
+        self._fen = chess.STARTING_FEN
+        self._search_info = None
 
         self._log_level = log_level
         self._logger = Logger(level=self._log_level)
@@ -1397,7 +4375,7 @@ class StockfishVariant:
             self.initiate()
 
     def initiate(self):
-        self._stockfish = Stockfish(
+        self._stockfish = stockfish.Stockfish(
             path=self.get_path(),
             depth=self._depth,
             parameters=self.get_parameters(),
@@ -1406,6 +4384,30 @@ class StockfishVariant:
         self._logger.info("Stockfish version", self._version, "initiated.")
         return self._stockfish
 
+    def restart(self):
+        """
+        Replace a crashed or hung engine process with a new one, keeping all settings,
+        including the current node budget.
+        """
+        self._logger.info("Restarting Stockfish version", self._version)
+        if self._initiated and self._stockfish._stockfish.poll() is None:
+            self._stockfish._stockfish.kill()
+            self._stockfish._stockfish.wait()
+        return self.initiate()
+
+    def set_affinity(self, cpus):
+        """
+        Pin the engine process, and all its search threads, to the given CPUs (Linux only).
+        """
+        pid = self._stockfish._stockfish.pid
+        try:
+            tasks = [int(tid) for tid in os.listdir("/proc/{}/task".format(pid))]
+        except OSError:
+            tasks = [pid]
+        for tid in tasks:
+            os.sched_setaffinity(tid, cpus)
+        self._logger.debug("Pinned Stockfish to CPUs", sorted(cpus))
+
     def get_version(self):
         return self._version
 
@@ -1431,7 +4433,7 @@ class StockfishVariant:
         return self._parameters
 
     def set_parameters(self):
-        self._parameters = self._default_parameters
+        self._parameters = dict(self._default_parameters)
         self._parameters["Threads"] = self._threads
         self._parameters["Hash"] = self._hash
         self._parameters["MultiPV"] = self._multi_pv
@@ -1440,6 +4442,22 @@ class StockfishVariant:
     def get_release_date(self):
         return self.get_long_version()["release_date"]
 
+    @classmethod
+    def is_available(cls, version, date):
+        """
+        Whether a version was released on or before date. Unknown dates and versions
+        without a release date count as available.
+        """
+        if date is None:
+            return True
+        for cdict in cls._versions:
+            if cdict["version"] == version:
+                release_date = datetime.datetime.strptime(
+                    cdict["release_date"], "%Y-%m-%d"
+                )
+                return release_date <= date
+        return True
+
     def get_long_version(self):
         return [cdict for cdict in self._versions if cdict["version"] == self._version][
             0
@@ -1448,41 +4466,512 @@ class StockfishVariant:
     def get_nnue(self):
         return self.get_long_version()["nnue"]
 
+    @Profiler.stage("engine_position")
     def set_position(self, fen, refresh=True):
         self._logger.debug("Setting position", fen)
+        self._fen = fen
         return self._stockfish.set_fen_position(fen, refresh)
 
+    @Profiler.stage("engine_position")
+    def set_moves(self, moves, fen, start_fen=None, new_game=False):
+        """
+        Set the position as a move sequence from the start of the game, the way a GUI does
+        during play. ucinewgame is only sent with new_game, so the hash stays warm between plies.
+        """
+        self._logger.debug("Setting position by moves", fen)
+        self._fen = fen
+        self._stockfish._prepare_for_new_position(new_game)
+        if start_fen is None or start_fen == chess.STARTING_FEN:
+            command = "position startpos"
+        else:
+            command = "position fen " + start_fen
+        if moves:
+            command += " moves " + " ".join(moves)
+        self._stockfish._put(command)
+
+    def set_multi_pv(self, multi_pv):
+        if multi_pv == self._multi_pv:
+            return
+        self._logger.debug("Setting MultiPV", multi_pv)
+        self._multi_pv = multi_pv
+        self._parameters["MultiPV"] = multi_pv
+        self._stockfish._set_option("MultiPV", multi_pv)
+
     def is_fen_valid(self, fen):
         self._logger.debug("Validating FEN.")
         return self._stockfish.is_fen_valid(fen)
 
     def set_num_nodes(self, num_nodes):
         self._logger.debug("Setting num nodes", num_nodes)
+        self._num_nodes = self.parse_num_nodes(num_nodes)
+
+    @staticmethod
+    def parse_num_nodes(num_nodes):
+        num_nodes = str(num_nodes)
         num_nodes = num_nodes.replace("M", "000000")
         num_nodes = num_nodes.replace("m", "000000")
         num_nodes = num_nodes.replace("K", "000")
         num_nodes = num_nodes.replace("k", "000")
-        self._num_nodes = (
-            int(num_nodes) if int(num_nodes) > 100000 else 100000
-        )  # 100k minimum
+        return int(num_nodes) if int(num_nodes) > 100000 else 100000  # 100k minimum
+
+    @classmethod
+    def parse_early_stop(cls, early_stop):
+        """
+        Early stop criteria: None or False to always spend the full budget, True for the
+        defaults, or a dict overriding some of them.
+        """
+        if not early_stop:
+            return None
+        criteria = dict(cls._early_stop_defaults)
+        if isinstance(early_stop, dict):
+            unknown = set(early_stop) - set(criteria)
+            if unknown:
+                raise ValueError(
+                    "Unknown early stop criteria: {}".format(sorted(unknown))
+                )
+            criteria.update(early_stop)
+        return criteria
 
     def evaluate_position(self):
         self._logger.debug("Evaluating position.")
 
-        if self._raw_output:
-            top_moves = self._stockfish.get_raw_lines(
-                multi_pv=self._multi_pv, num_nodes=self._num_nodes
-            )
+        lines = self._search()
+        top_moves = self._parse_lines(lines, all_iterations=self._raw_output)
+
+        self._logger.debug("Result of evaluation:", top_moves)
+        return top_moves
+
+    @Profiler.stage("engine_search")
+    def _search(self):
+        """
+        Run a search on the current position and return the engine's info lines.
+        Talks UCI directly, so it works with any Stockfish wrapper version.
+        """
+        started = time.perf_counter()
+        if self._mode == "depth":
+            self._stockfish._put("go depth {}".format(self._depth))
         else:
-            top_moves = self._stockfish.get_top_moves(
-                num_top_moves=self._multi_pv,
-                include_info=True,
-                num_nodes=self._num_nodes,
+            self._stockfish._put("go nodes {}".format(self._num_nodes))
+
+        early_stop = self._early_stop is not None and self._mode == "nodes"
+        if early_stop:
+            legal_moves = chess.Board(self._fen).legal_moves.count()
+            num_pv = max(min(self._multi_pv, legal_moves), 1)
+            iterations, iteration = [], {}
+
+        lines = []
+        stopped, kept = None, None
+        while True:
+            line = self._stockfish._read_line()
+            if line.startswith("bestmove"):
+                break
+            if not line.startswith("info"):
+                continue
+            lines.append(line)
+            if not early_stop or stopped is not None:
+                continue
+            if self._add_iteration_line(line, num_pv, iterations, iteration):
+                iteration = {}
+                stopped = self._get_early_stop_reason(iterations, legal_moves)
+                if stopped is not None:
+                    # lines after stop may belong to an unfinished iteration, leave them out
+                    self._stockfish._put("stop")
+                    kept = len(lines)
+
+        self._set_search_info(lines, time.perf_counter() - started, stopped)
+        return lines if kept is None else lines[:kept]
+
+    def _add_iteration_line(self, line, num_pv, iterations, iteration):
+        """
+        Collect the best move, score and the gap to the second best of an iteration. Returns
+        True when the line completes one.
+        """
+        fields = line.split(" ")
+        if "pv" not in fields or "multipv" not in fields or "score" not in fields:
+            return False
+        if "lowerbound" in fields or "upperbound" in fields:
+            return False
+        kind, value = fields[fields.index("score") + 1 : fields.index("score") + 3]
+        score = int(value) if kind == "cp" else (100000 if int(value) > 0 else -100000)
+        multipv = int(fields[fields.index("multipv") + 1])
+        if multipv == 1:
+            iteration.update(
+                move=fields[fields.index("pv") + 1],
+                score=score,
+                nodes=int(fields[fields.index("nodes") + 1]),
             )
+        elif multipv == 2 and "score" in iteration:
+            iteration["gap"] = iteration["score"] - score
+        if multipv < num_pv or "move" not in iteration:
+            return False
+        iterations.append(dict(iteration))
+        return True
 
-        self._logger.debug("Result of evaluation:", top_moves)
+    def _get_early_stop_reason(self, iterations, legal_moves):
+        """
+        Whether the search is settled: an only move, an evaluation that has stayed decisive
+        for decisive_depths iterations, or a best move and score that have been stable for
+        stable_depths iterations while clearly ahead of the second best. Close positions
+        never meet the last one, so they keep the full budget.
+        """
+        criteria = self._early_stop
+        if criteria["only_move"] and legal_moves == 1:
+            return "only_move"
+        if iterations[-1]["nodes"] < criteria["min_nodes"]:
+            return None
+
+        decisive = iterations[-criteria["decisive_depths"] :]
+        if len(decisive) == criteria["decisive_depths"] and all(
+            abs(i["score"]) >= criteria["decisive_cp"] for i in decisive
+        ):
+            return "decisive"
+
+        stable = iterations[-criteria["stable_depths"] :]
+        scores = [i["score"] for i in stable]
+        if (
+            len(stable) == criteria["stable_depths"]
+            and len({i["move"] for i in stable}) == 1
+            and max(scores) - min(scores) <= criteria["stable_cp"]
+            and all(i.get("gap", 100000) >= criteria["stable_gap_cp"] for i in stable)
+        ):
+            return "stable"
+        return None
+
+    def _set_search_info(self, lines, wall_time, stopped_early=None):
+        """
+        Keep telemetry of the last search, from the last info line reporting nodes, so an
+        early stop counts the nodes actually spent.
+        """
+        info = {"nodes": 0, "nps": 0, "hashfull": 0, "time": 0, "depth": 0}
+        for line in reversed(lines):
+            fields = line.split(" ")
+            if "nodes" in fields:
+                for name in info:
+                    if name in fields:
+                        info[name] = int(fields[fields.index(name) + 1])
+                break
+        info["wall_time"] = wall_time
+        info["stopped_early"] = stopped_early
+        self._search_info = info
+
+    def get_search_info(self):
+        return self._search_info
+
+    def _parse_lines(self, lines, all_iterations=False):
+        """
+        Parse info lines into top moves of the final iteration, ordered by multipv. With
+        all_iterations (raw output), every iteration is included, grouped by nodes with the
+        deepest first. Either way the first item is the best move of the final search.
+        """
+        multiplier = 1 if self._fen.split(" ")[1] == "w" else -1
+        iterations = {}
+        for line in lines:
+            fields = line.split(" ")
+            if "pv" not in fields or "multipv" not in fields:
+                continue
+            if "lowerbound" in fields or "upperbound" in fields:
+                continue
+            top_move = self._parse_line(fields, multiplier)
+            iterations.setdefault(top_move["Nodes"], []).append(top_move)
+
+        top_moves = []
+        for nodes in reversed(list(iterations)):
+            top_moves.extend(
+                sorted(iterations[nodes], key=lambda m: int(m["MultiPVLine"]))
+            )
+            if not all_iterations:
+                break
         return top_moves
 
+    def _parse_line(self, fields, multiplier):
+        def pick(name, offset=1):
+            return fields[fields.index(name) + offset] if name in fields else None
+
+        centipawn = pick("cp")
+        mate = pick("mate")
+        return {
+            "Move": pick("pv"),
+            "Centipawn": int(centipawn) * multiplier if centipawn is not None else None,
+            "Mate": int(mate) * multiplier if mate is not None else None,
+            "Depth": pick("depth"),
+            "SelectiveDepth": pick("seldepth"),
+            "Time": pick("time"),
+            "Nodes": pick("nodes"),
+            "NodesPerSecond": pick("nps"),
+            "MultiPVLine": pick("multipv"),
+            "WDL": " ".join([pick("wdl", 1), pick("wdl", 2), pick("wdl", 3)])
+            if "wdl" in fields
+            else None,
+        }
+
     def quit(self):
         self._logger.debug("Quitting.")
-        self._stockfish.send_quit_command()
+        self._stockfish._put("quit")
+        self._stockfish._stockfish.wait()
+
+
+def main(argv=None):
+    """
+    Command line interface, eg. python catchfish.py evaluate games.pgn --nodes 30M
+    Subcommands only import what they use, so --help and stats start fast.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="catchfish", description="Evaluate and analyse chess games with Stockfish."
+    )
+    parser.add_argument("--log-level", default="none", choices=Logger.levels)
+    parser.add_argument(
+        "--profile", choices=Profiler.modes, help="time the stages of the command"
+    )
+    parser.add_argument(
+        "--profile-file", help="write the profile report here instead of to stderr"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    store = argparse.ArgumentParser(add_help=False)
+    store.add_argument("--redis-host", default="localhost")
+    store.add_argument("--redis-port", type=int, default=6379)
+    store.add_argument("--redis-db", type=int, default=1)
+
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("--player", dest="players", action="append")
+    filters.add_argument("--event", dest="events", action="append")
+    filters.add_argument("--date-from")
+    filters.add_argument("--date-to")
+    filters.add_argument("--min-elo", type=int)
+    filters.add_argument("--result", dest="results", action="append")
+
+    ingest = subparsers.add_parser(
+        "ingest", parents=[filters], help="read a PGN file and count its games"
+    )
+    ingest.add_argument("pgn")
+    ingest.add_argument("--limit-games", type=int, default=0)
+    ingest.set_defaults(func=_cli_ingest)
+
+    evaluate = subparsers.add_parser(
+        "evaluate", parents=[store, filters], help="evaluate the games of a PGN file"
+    )
+    evaluate.add_argument("pgn")
+    evaluate.add_argument("--limit-games", type=int, default=0)
+    evaluate.add_argument("--versions", type=int, nargs="+", default=[15])
+    evaluate.add_argument("--nodes", nargs="+", default=["30M"])
+    evaluate.add_argument("--threads", type=int, default=32)
+    evaluate.add_argument("--hash", type=int, default=1024)
+    evaluate.add_argument("--multi-pv", type=int, default=3)
+    evaluate.add_argument("--depth", type=int, default=20)
+    evaluate.add_argument("--mode", choices=["nodes", "depth"], default="nodes")
+    evaluate.add_argument("--no-historical", action="store_true")
+    evaluate.add_argument(
+        "--skip-stored-games",
+        action="store_true",
+        help="skip games already stored by an earlier run, even from another source",
+    )
+    evaluate.add_argument("--processes", type=int, default=1)
+    evaluate.add_argument(
+        "--pin", action="store_true", help="pin each local worker to its own CPUs"
+    )
+    evaluate.add_argument("--distributed", action="store_true")
+    evaluate.add_argument("--priority", choices=JobQueue.priorities, default="normal")
+    evaluate.add_argument("--batch", help="batch name, to share workers fairly")
+    evaluate.add_argument("--local-workers", type=int)
+    evaluate.add_argument("--continuous", action="store_true")
+    evaluate.add_argument("--reverse", action="store_true")
+    evaluate.add_argument(
+        "--early-stop",
+        action="store_true",
+        help="stop searches once the result is settled, instead of spending all nodes",
+    )
+    evaluate.add_argument(
+        "--adaptive-multi-pv",
+        type=int,
+        help="search with this MultiPV first, and with --multi-pv only if the played move "
+        "is not among the lines",
+    )
+    evaluate.add_argument("--binaries-folder")
+    evaluate.add_argument("--engine-log-file")
+    evaluate.add_argument("--metrics-file")
+    evaluate.add_argument("--status-file")
+    evaluate.set_defaults(func=_cli_evaluate)
+
+    analyse = subparsers.add_parser(
+        "analyse", parents=[store], help="analyse stored evaluations, by key or filter"
+    )
+    analyse.add_argument("keys", nargs="*")
+    analyse.add_argument("--player")
+    analyse.add_argument("--event")
+    analyse.add_argument("--version", type=int)
+    analyse.add_argument("--num-nodes")
+    analyse.add_argument("--date-from")
+    analyse.add_argument("--date-to")
+    analyse.add_argument("--move-data", action="store_true")
+    analyse.add_argument("--ignore-first-moves", type=int, default=10)
+    analyse.add_argument("--ignore-forced-moves", type=int, default=3)
+    analyse.set_defaults(func=_cli_analyse)
+
+    reindex = subparsers.add_parser(
+        "reindex", parents=[store], help="index games stored before the indexes existed"
+    )
+    reindex.set_defaults(func=_cli_reindex)
+
+    export = subparsers.add_parser(
+        "export", parents=[store], help="export the store to an on-disk archive"
+    )
+    export.add_argument("path")
+    export.add_argument("--prefixes", nargs="+", default=["position:", "game:"])
+    export.add_argument(
+        "--import", dest="load", action="store_true", help="load the archive instead"
+    )
+    export.set_defaults(func=_cli_export)
+
+    stats = subparsers.add_parser(
+        "stats", help="show progress and metrics of a running evaluation"
+    )
+    stats.add_argument("status_file")
+    stats.add_argument("--metrics-file")
+    stats.set_defaults(func=_cli_stats)
+
+    args = parser.parse_args(argv)
+    if not args.profile:
+        return args.func(args)
+
+    profiler = Profiler(mode=args.profile, log_level=args.log_level).start()
+    try:
+        return args.func(args)
+    finally:
+        profiler.stop()
+        report = profiler.report(args.profile_file)
+        if not args.profile_file:
+            sys.stderr.write(report)
+
+
+def _cli_catchfish(args, **kwargs):
+    return Catchfish(
+        log_level=args.log_level,
+        redis_host=args.redis_host,
+        redis_port=args.redis_port,
+        redis_db=args.redis_db,
+        **kwargs,
+    )
+
+
+def _cli_filters(args):
+    return {
+        "players": args.players,
+        "events": args.events,
+        "date_from": args.date_from,
+        "date_to": args.date_to,
+        "min_elo": args.min_elo,
+        "results": args.results,
+    }
+
+
+def _cli_ingest(args):
+    # games are not FEN validated, so no engine is needed
+    games = Games(
+        path=args.pgn,
+        stockfish_variant=StockfishVariant(log_level=args.log_level),
+        limit_games=args.limit_games,
+        log_level=args.log_level,
+        **_cli_filters(args),
+    )
+    print(
+        json.dumps(
+            {
+                "games": games.get_valid_games_count(),
+                "invalid_games": games.get_invalid_games_count(),
+                "filtered_games": games.get_filtered_games_count(),
+                "duplicate_games": games.get_duplicate_games_count(),
+                "positions": sum(g.get_positions_count() for g in games.get_games()),
+            }
+        )
+    )
+
+
+def _cli_evaluate(args):
+    fish = _cli_catchfish(
+        args,
+        limit_games=args.limit_games,
+        stockfish_versions=args.versions,
+        historical=not args.no_historical,
+        threads=args.threads,
+        hash_size=args.hash,
+        depth=args.depth,
+        multi_pv=args.multi_pv,
+        num_nodes=args.nodes,
+        mode=args.mode,
+        engine_log_file=args.engine_log_file,
+        metrics_file=args.metrics_file,
+        status_file=args.status_file,
+        processes=args.processes,
+        pin=args.pin,
+        continuous=args.continuous,
+        reverse=args.reverse,
+        early_stop=args.early_stop,
+        adaptive_multi_pv=args.adaptive_multi_pv,
+        binaries_folder=args.binaries_folder,
+    )
+    fish.load_games(
+        args.pgn, skip_stored_games=args.skip_stored_games, **_cli_filters(args)
+    )
+    evaluation = fish.evaluate(
+        distributed=args.distributed,
+        local_workers=args.local_workers,
+        priority=args.priority,
+        batch=args.batch,
+    )
+    print(json.dumps(evaluation.get_result_keys()))
+
+
+def _cli_analyse(args):
+    fish = _cli_catchfish(args)
+    keys = args.keys
+    filters = {
+        "player": args.player,
+        "event": args.event,
+        "version": args.version,
+        "num_nodes": args.num_nodes,
+        "date_from": args.date_from,
+        "date_to": args.date_to,
+    }
+    filters = {name: value for name, value in filters.items() if value is not None}
+    if filters:
+        keys = keys + fish.find_keys(**filters)
+    for key in keys:
+        print(
+            fish.analyse(
+                key=key,
+                return_move_data=args.move_data,
+                ignore_first_moves=args.ignore_first_moves,
+                ignore_forced_moves=args.ignore_forced_moves,
+            )
+        )
+
+
+def _cli_reindex(args):
+    print(json.dumps({"games": _cli_catchfish(args).reindex()}))
+
+
+def _cli_export(args):
+    fish = _cli_catchfish(args)
+    if args.load:
+        count = fish.import_archive(args.path)
+    else:
+        count = fish.export_archive(args.path, prefixes=args.prefixes)
+    print(json.dumps({"records": count}))
+
+
+def _cli_stats(args):
+    with open(args.status_file) as f:
+        result = {"status": json.load(f)}
+    if args.metrics_file:
+        with open(args.metrics_file) as f:
+            metrics = f.read()
+        result["metrics"] = (
+            metrics if args.metrics_file.endswith(".prom") else json.loads(metrics)
+        )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
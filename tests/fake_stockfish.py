@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in for a Stockfish binary, speaking enough UCI for StockfishVariant.
+
+Scores are derived from a hash of position and move, so the same position always gives the
+same output. Latency is configurable through the environment:
+
+    FAKE_STOCKFISH_NPS      simulated nodes per second, used for reported time/nps (default 1M)
+    FAKE_STOCKFISH_LATENCY  real seconds slept per 1M searched nodes on one thread (default 0)
+    FAKE_STOCKFISH_CRASH    FENs, separated by ";", on which a search crashes the engine
+
+The version is taken from the file name, eg. a symlink named stockfish-14 reports version 14.
+"""
+
+import os, re, sys, math, random, hashlib, threading, time
+import chess, chess.pgn, chess.polyglot
+
+
+class FakeStockfish:
+    def __init__(self, version=15):
+        self._version = version
+        self._board = chess.Board()
+        self._options = {"Threads": 1, "Hash": 16, "MultiPV": 1}
+        self._hash_nodes = 0
+        self._nps = int(float(os.environ.get("FAKE_STOCKFISH_NPS", 1000000)))
+        self._latency = float(os.environ.get("FAKE_STOCKFISH_LATENCY", 0))
+        self._crash_fens = [
+            fen for fen in os.environ.get("FAKE_STOCKFISH_CRASH", "").split(";") if fen
+        ]
+        self._search = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self):
+        self._print(
+            "Stockfish {} by the Stockfish developers (see AUTHORS file)".format(
+                self._version
+            )
+        )
+        for line in sys.stdin:
+            command = line.strip()
+            if not command:
+                continue
+            if command == "quit":
+                self._stop_search()
+                break
+            self._command(command)
+
+    def _print(self, *lines):
+        with self._lock:
+            for line in lines:
+                sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def _command(self, command):
+        name, _, args = command.partition(" ")
+        if name == "uci":
+            self._print(
+                "id name Stockfish {}".format(self._version),
+                "id author the Stockfish developers (see AUTHORS file)",
+                "",
+                "option name Threads type spin default 1 min 1 max 1024",
+                "option name Hash type spin default 16 min 1 max 33554432",
+                "option name MultiPV type spin default 1 min 1 max 500",
+                "option name UCI_ShowWDL type check default false",
+                "uciok",
+            )
+        elif name == "isready":
+            self._print("readyok")
+        elif name == "setoption":
+            match = re.match(r"name (.+?) value (.*)", args)
+            if match:
+                self._options[match.group(1)] = match.group(2)
+        elif name == "ucinewgame":
+            self._stop_search()
+            self._hash_nodes = 0
+        elif name == "position":
+            self._stop_search()
+            self._set_position(args.split())
+        elif name == "d":
+            self._print(
+                str(self._board),
+                "",
+                "Fen: " + self._board.fen(),
+                "Key: {:016X}".format(chess.polyglot.zobrist_hash(self._board)),
+                "Checkers: "
+                + " ".join(chess.square_name(s) for s in self._board.checkers()),
+            )
+        elif name == "go":
+            self._stop_search()
+            self._stop.clear()
+            self._search = threading.Thread(
+                target=self._go, args=(args.split(), self._board.copy())
+            )
+            self._search.start()
+        elif name == "stop":
+            self._stop_search()
+
+    def _stop_search(self):
+        if self._search is not None:
+            self._stop.set()
+            self._search.join()
+            self._search = None
+
+    def _set_position(self, args):
+        if not args:
+            return
+        if args[0] == "startpos":
+            board = chess.Board()
+            rest = args[1:]
+        else:
+            end = args.index("moves") if "moves" in args else len(args)
+            board = chess.Board(" ".join(args[1:end]))
+            rest = args[end:]
+        if rest and rest[0] == "moves":
+            for uci in rest[1:]:
+                board.push_uci(uci)
+        self._board = board
+
+    def _go(self, args, board):
+        if board.fen() in self._crash_fens:
+            sys.stdout.flush()
+            os._exit(1)
+        num_nodes = self._arg(args, "nodes")
+        max_depth = self._arg(args, "depth")
+        if num_nodes is None and max_depth is None:
+            max_depth = 20
+        searchmoves = (
+            args[args.index("searchmoves") + 1 :] if "searchmoves" in args else None
+        )
+
+        moves = sorted(m.uci() for m in board.legal_moves)
+        if searchmoves:
+            moves = [m for m in moves if m in searchmoves]
+        if not moves:
+            score = "mate 0" if board.is_checkmate() else "cp 0"
+            self._print("info depth 0 score " + score, "bestmove (none)")
+            return
+
+        multi_pv = min(int(self._options.get("MultiPV", 1)), len(moves))
+        key = board.fen()
+        depth, nodes, best = 0, 0, None
+        while True:
+            next_nodes = self._nodes_at_depth(depth + 1, len(moves))
+            if depth > 0 and (
+                (num_nodes is not None and next_nodes > num_nodes)
+                or (max_depth is not None and depth + 1 > max_depth)
+                or depth >= 245
+            ):
+                break
+            if depth > 0 and self._stop.is_set():
+                break
+            depth += 1
+            if self._latency:
+                threads = int(self._options.get("Threads", 1))
+                time.sleep(self._latency * (next_nodes - nodes) / 1000000 / threads)
+            nodes = next_nodes
+            ranked = sorted(moves, key=lambda m: (-self._score(key, m, depth), m))
+            best = ranked[:multi_pv]
+            lines = []
+            for k, move in enumerate(best):
+                lines.append(self._info_line(board, depth, k + 1, move, nodes, key))
+            self._print(*lines)
+
+        self._hash_nodes += nodes
+        self._print("bestmove " + best[0])
+
+    def _info_line(self, board, depth, multipv, move, nodes, key):
+        cp = self._score(key, move, depth)
+        win = int(1000 / (1 + math.exp(-cp / 100.0)) * 0.6)
+        loss = int(1000 / (1 + math.exp(cp / 100.0)) * 0.6)
+        hash_entries = int(self._options.get("Hash", 16)) * 1024 * 1024 // 16
+        hashfull = min(1000, (self._hash_nodes + nodes) * 1000 // max(hash_entries, 1))
+        ms = nodes * 1000 // self._nps
+        return (
+            "info depth {d} seldepth {sd} multipv {k} score cp {cp} wdl {w} {dr} {l} "
+            "nodes {n} nps {nps} hashfull {h} tbhits 0 time {t} pv {pv}".format(
+                d=depth,
+                sd=depth + 4,
+                k=multipv,
+                cp=cp,
+                w=win,
+                dr=1000 - win - loss,
+                l=loss,
+                n=nodes,
+                nps=self._nps,
+                h=hashfull,
+                t=ms,
+                pv=move,
+            )
+        )
+
+    def _nodes_at_depth(self, depth, legal_moves):
+        return int(legal_moves * 50 * 2**depth)
+
+    def _score(self, key, move, depth):
+        # stable base score per move, with a jitter that fades out as depth grows
+        digest = hashlib.md5((key + move).encode("utf-8")).digest()
+        base = int.from_bytes(digest[:2], "big") % 301 - 150
+        jitter = int.from_bytes(digest[2:4], "big") % 61 - 30
+        return base + jitter // depth
+
+    def _arg(self, args, name):
+        return int(args[args.index(name) + 1]) if name in args else None
+
+
+def make_binaries_folder(path, versions=(9, 10, 11, 12, 13, 14, 15)):
+    """
+    Lay out a binaries folder the way StockfishVariant expects it, with every version
+    pointing at this fake engine.
+    """
+    script = os.path.abspath(__file__)
+    os.chmod(script, 0o755)
+    for version in versions:
+        folder = os.path.join(path, "stockfish-{}".format(version))
+        os.makedirs(folder, exist_ok=True)
+        binary = os.path.join(folder, "stockfish-{}".format(version))
+        if not os.path.exists(binary):
+            os.symlink(script, binary)
+    return str(path)
+
+
+def make_pgn(num_games=10, plies=60, seed=0, date="2022.08.18"):
+    """
+    Deterministic PGN with random legal games, for tests and benchmarks.
+    """
+    rnd = random.Random(seed)
+    exporter_games = []
+    for i in range(num_games):
+        game = chess.pgn.Game()
+        game.headers["Event"] = "Fake Open"
+        game.headers["Site"] = "?"
+        game.headers["Date"] = date
+        game.headers["Round"] = str(i + 1)
+        game.headers["White"] = "Player {}".format(rnd.randint(1, 20))
+        game.headers["Black"] = "Player {}".format(rnd.randint(21, 40))
+        game.headers["WhiteElo"] = str(rnd.randint(2400, 2850))
+        game.headers["BlackElo"] = str(rnd.randint(2400, 2850))
+        board = chess.Board()
+        node = game
+        for _ in range(plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rnd.choice(moves)
+            node = node.add_variation(move)
+            board.push(move)
+        game.headers["Result"] = board.result()
+        game.headers["PlyCount"] = str(board.ply())
+        exporter_games.append(str(game))
+    return "\n\n".join(exporter_games) + "\n"
+
+
+if __name__ == "__main__":
+    match = re.search(r"(\d+)$", os.path.basename(sys.argv[0]))
+    FakeStockfish(version=int(match.group(1)) if match else 15).run()
@@ -1,9 +1,54 @@
 import pytest
 from timeit import default_timer
 import time
+import io
 import os
+import sys
+import json
+import chess
+import subprocess
 
-from catchfish import StockfishVariant, Games, Game
+from catchfish import (
+    Catchfish,
+    StockfishVariant,
+    Games,
+    Game,
+    Analysis,
+    MoveRecord,
+    Evaluation,
+    Comparison,
+    Archive,
+    GameIndex,
+    MemoryStore,
+    Tuner,
+    JobQueue,
+    Worker,
+    Profiler,
+    main,
+)
+from tests.fake_stockfish import make_binaries_folder, make_pgn
+
+
+def make_evaluation(games, binaries_folder, **settings):
+    """
+    Evaluation with the fake engine, one thread and an in-process store, unless overridden
+    """
+    settings = dict(
+        dict(
+            games=games,
+            stockfish_versions=[15],
+            log_level="none",
+            threads=1,
+            hash=16,
+            multi_pv=3,
+            num_nodes=["100K"],
+            binaries_folder=binaries_folder,
+        ),
+        **settings,
+    )
+    if "store" not in settings:
+        settings["store"] = MemoryStore(log_level="none")
+    return Evaluation(**settings)
 
 
 class TestStockfishVariant:
@@ -40,3 +85,794 @@ class TestGames:
         file = os.path.join(os.path.dirname(__file__), "test.pgn")
         games.read_file(file)
         assert len(games._games) > 0
+
+    def test_header_filters(self):
+        pgn = make_pgn(num_games=30, plies=10)
+        everything = Games(
+            pgn=io.StringIO(pgn), stockfish_variant=StockfishVariant(), log_level="none"
+        ).get_games()
+
+        def load(**filters):
+            return Games(
+                pgn=io.StringIO(pgn),
+                stockfish_variant=StockfishVariant(),
+                log_level="none",
+                **filters,
+            )
+
+        white = everything[0].get_header("White")
+        by_player = load(players=[white], date_from="2022.01.01")
+        assert [g.get_info_string() for g in by_player.get_games()] == [
+            g.get_info_string()
+            for g in everything
+            if white in (g.get_header("White"), g.get_header("Black"))
+        ]
+        assert by_player.get_filtered_games_count() == 28
+
+        strong = load(min_elo=2600)
+        assert 0 < strong.get_valid_games_count() < 30
+        for g in strong.get_games():
+            assert int(g.get_header("WhiteElo")) >= 2600
+            assert int(g.get_header("BlackElo")) >= 2600
+
+        assert load(date_to="2021.12.31").get_valid_games_count() == 0
+
+    def test_duplicates(self):
+        pgn = make_pgn(num_games=3, plies=10)
+        # the same games from another source, with other headers
+        copy = (
+            pgn.replace('[Date "2022.08.18"]', '[Date "2022-08-18"]')
+            .replace('[Event "Fake Open"]', '[Event "Fake Open 2022"]')
+            .replace('[White "Player ', '[White "P. Player ')
+        )
+        games = Games(
+            pgn=io.StringIO(pgn), stockfish_variant=StockfishVariant(), log_level="none"
+        )
+        games.add_pgn(io.StringIO(copy))
+        assert games.get_valid_games_count() == 3
+        assert games.get_duplicate_games_count() == 3
+
+        # forfeits by the same players in the same year are different games
+        forfeits = "\n".join(
+            make_pgn(num_games=1, plies=0, date=date).replace(
+                '[Round "1"]', '[Round "{}"]'.format(round)
+            )
+            for date, round in (("2022.08.18", 1), ("2022.08.19", 1), ("2022.08.19", 2))
+        )
+        games = Games(
+            pgn=io.StringIO(forfeits),
+            stockfish_variant=StockfishVariant(),
+            log_level="none",
+        )
+        assert games.get_valid_games_count() == 3
+        assert games.get_duplicate_games_count() == 0
+
+
+class TestAnalysis:
+    """
+    Test Analysis class
+    """
+
+    @pytest.fixture
+    def evaluation(self):
+        pgn = '[White "A"]\n[Black "B"]\n[Result "*"]\n\n1. e4 e5 2. Nf3 *'
+        evaluation = []
+        for best, played in [("e2e4", "e2e4"), ("c7c5", "e7e5"), ("g1f3", "g1f3")]:
+            evaluation.append(
+                {
+                    "evaluation": [
+                        {
+                            "Move": best,
+                            "Centipawn": 30,
+                            "Mate": None,
+                            "Nodes": "2000",
+                            "Depth": "2",
+                            "Time": "1",
+                            "WDL": "100 850 50",
+                        },
+                        {
+                            "Move": played,
+                            "Centipawn": 10,
+                            "Mate": None,
+                            "Nodes": "2000",
+                            "Depth": "2",
+                            "Time": "1",
+                            "WDL": "80 850 70",
+                        },
+                    ],
+                    "position": "fen",
+                }
+            )
+        return {"pgn": pgn, "evaluation": evaluation}
+
+    def test_move_records(self, evaluation):
+        analysis = Analysis(evaluation=evaluation, log_level="none")
+        moves = analysis._moves
+        assert len(moves) == 3
+        assert all(isinstance(move, MoveRecord) for move in moves)
+        assert moves[0]["turn"] == "white" and moves[1]["turn"] == "black"
+        assert moves[1]["move"] == "e7e5"
+        assert moves[0].legal_moves_count == 20
+        assert moves[0].material_count == [39, 39]
+
+    def test_analyse_output(self, evaluation):
+        analysis = Analysis(evaluation=evaluation, log_level="none")
+        result = json.loads(analysis.analyse())
+        move = result["moves"][1]
+        assert list(move)[:4] == ["fullmove_number", "ply", "turn", "move"]
+        assert "evaluation" not in move and "board" not in move
+        assert move["centipawn_loss"] == 20
+        assert move["top_engine_move"] == 2
+        assert move["legal_moves"] == 20
+
+
+class TestEvaluation:
+    """
+    Test Evaluation class, using the fake UCI engine and the in-process store
+    """
+
+    @pytest.fixture
+    def binaries_folder(self, tmp_path):
+        return make_binaries_folder(tmp_path)
+
+    @pytest.fixture
+    def games(self):
+        return Games(
+            pgn=io.StringIO(make_pgn(num_games=2, plies=12)),
+            stockfish_variant=StockfishVariant(),
+            log_level="none",
+        )
+
+    @pytest.fixture
+    def evaluation(self, games, binaries_folder):
+        return make_evaluation(games, binaries_folder)
+
+    def test_evaluate(self, evaluation):
+        evaluation.evaluate()
+        results = evaluation.get_results()
+        assert len(results) == 2
+        position = results[0]["evaluation"][0]
+        assert len(position["evaluation"]) == 3
+        assert position["evaluation"][0]["MultiPVLine"] == "1"
+        assert position["position"] == chess.STARTING_FEN
+
+        # stored game records only reference the position evaluations
+        stored = evaluation._store.get(evaluation.get_result_keys()[0]["key"])
+        # keyed by the Zobrist hash of the starting position
+        assert stored["evaluation"][0]["key"].startswith("position:")
+        assert stored["evaluation"][0]["key"].endswith(":463b96181691fc9c")
+        assert "evaluation" not in stored["evaluation"][0]
+
+    def test_evaluation_is_deterministic(self, evaluation, games, binaries_folder):
+        evaluation.evaluate()
+        again = make_evaluation(games, binaries_folder)
+        again.evaluate()
+        assert evaluation.get_result_keys() == again.get_result_keys()
+
+    def test_get_evaluations(self, evaluation):
+        evaluation.evaluate()
+        results = evaluation.get_results()
+        keys = evaluation.get_result_keys()
+        assert list(evaluation.get_evaluations(keys, batch_size=1)) == results
+        scanned = list(evaluation.get_evaluations())
+        assert sorted(r["description"] for r in scanned) == sorted(
+            r["description"] for r in results
+        )
+        assert list(evaluation.get_evaluations(keys, prefix="other:")) == []
+
+    def test_find_keys(self, evaluation, games):
+        evaluation.evaluate()
+        keys = sorted(item["key"] for item in evaluation.get_result_keys())
+        white = games.get_games()[0].get_info()["white"]
+        assert evaluation.get_result_keys()[0]["key"] in evaluation.find_keys(
+            player=white
+        )
+        assert evaluation.find_keys(version=15, num_nodes="100000") == keys
+        assert evaluation.find_keys(version=15, num_nodes="1M") == []
+        assert evaluation.find_keys(event="Fake Open", date_from="2022.01.01") == keys
+        assert evaluation.find_keys(date_to="2021.12.31") == []
+        assert evaluation.find_keys(num_nodes="100K") == keys
+
+        # games stored before the indexes existed are found after a reindex
+        for index_key in list(evaluation._store.scan_iter("index:*")):
+            evaluation._store.delete(index_key)
+        assert evaluation.find_keys(num_nodes="100K") == []
+        assert GameIndex(evaluation._store, log_level="none").reindex() == 2
+        assert evaluation.find_keys(version=15, num_nodes="100K") == keys
+
+    def test_compare(self, games, binaries_folder):
+        evaluation = make_evaluation(
+            games,
+            binaries_folder,
+            stockfish_versions=[14, 15],
+            num_nodes=["100K", "1M"],
+        )
+        evaluation.evaluate()
+        comparison = json.loads(
+            Comparison(evaluation.get_results(), log_level="none").compare()
+        )
+        assert comparison["settings"] == [
+            "14@100000",
+            "14@1000000",
+            "15@100000",
+            "15@1000000",
+        ]
+        assert len(comparison["games"]) == 2
+        assert len(comparison["games"][0]["plies"]) == 12
+        top_1 = comparison["agreement"]["top_1"]
+        assert top_1["15@100000"]["15@100000"] == 1.0
+        # the fake engine only depends on the position, not the version
+        assert top_1["14@1000000"]["15@1000000"] == 1.0
+
+        players = comparison["players"]
+        assert sum(p["moves"] for p in players.values()) == 24
+        for stats in players.values():
+            assert sum(stats["top_1_discovery"].values()) == stats["moves"]
+
+    def test_compare_raw_output(self, games, binaries_folder):
+        comparisons = []
+        for raw_output in (False, True):
+            evaluation = make_evaluation(games, binaries_folder, raw_output=raw_output)
+            evaluation.evaluate()
+            comparisons.append(
+                json.loads(
+                    Comparison(evaluation.get_results(), log_level="none").compare()
+                )
+            )
+        # only the final iteration of the raw output is ranked
+        assert comparisons[1] == comparisons[0]
+
+    def test_incremental_comparison(self, games, binaries_folder, monkeypatch):
+        store = MemoryStore(log_level="none")
+        results = []
+        for version in (15, 14):
+            evaluation = make_evaluation(
+                games, binaries_folder, stockfish_versions=[version], store=store
+            )
+            evaluation.evaluate()
+            results += evaluation.get_results()
+            fish = Catchfish(
+                stockfish_versions=[14, 15], num_nodes=["100K"], log_level="none"
+            )
+            fish._store = store
+            added = []
+            add = Comparison.add
+            monkeypatch.setattr(
+                Comparison, "add", lambda self, e: added.append(e) or add(self, e)
+            )
+            comparison = json.loads(fish.compare(name="fake"))
+            monkeypatch.undo()
+            # only the games of the new version are read
+            assert [e["engine"]["version"] for e in added] == [version, version]
+
+        expected = json.loads(Comparison(results, log_level="none").compare())
+        assert comparison["settings"] == ["14@100000", "15@100000"]
+        assert comparison["agreement"] == expected["agreement"]
+        assert comparison["players"] == expected["players"]
+
+        player = sorted(comparison["players"])[0]
+        scoped = json.loads(fish.compare(name="scoped", player=player))
+        assert set(scoped["players"]) < set(comparison["players"])
+        assert player in scoped["players"]
+
+    def test_archive(self, evaluation, tmp_path):
+        evaluation.evaluate()
+        results = evaluation.get_results()
+        archive = Archive(str(tmp_path / "archive"), log_level="none")
+        assert archive.export_store(evaluation._store) == 25
+
+        reader = Evaluation(
+            store=Archive(str(tmp_path / "archive"), log_level="none"),
+            log_level="none",
+        )
+        keys = evaluation.get_result_keys()
+        assert list(reader.get_evaluations(keys)) == results
+        assert reader.get_result_by_key("game:missing") is None
+
+        # a second export appends a segment, newer records win
+        key = keys[0]["key"]
+        archive.append([(key, {"updated": True})])
+        assert archive.get(key) == {"updated": True}
+        assert len(list(archive.scan_iter("game:*"))) == 2
+
+        store = MemoryStore(log_level="none")
+        assert archive.import_store(store) == 25
+        assert store.get(key) == {"updated": True}
+
+        # closing with a view still alive leaves its segment mapped until it's released
+        view = archive.get_raw(key)
+        archive.close()
+        assert json.loads(view.tobytes()) == {"updated": True}
+
+    def test_skip_stored_games_at_ingest(self, evaluation, binaries_folder):
+        evaluation.evaluate()
+
+        def ingest(versions):
+            return Games(
+                pgn=io.StringIO(make_pgn(num_games=3, plies=12)),
+                stockfish_variant=StockfishVariant(),
+                log_level="none",
+                fingerprint_store=evaluation._store,
+                fingerprint_settings=make_evaluation(
+                    None,
+                    binaries_folder,
+                    stockfish_versions=versions,
+                    store=evaluation._store,
+                ).get_settings_ids(),
+            )
+
+        # the first two games were stored by the evaluation
+        games = ingest([15])
+        assert games.get_valid_games_count() == 1
+        assert games.get_duplicate_games_count() == 2
+        # not with another version, which can still be added
+        for versions in ([14], [14, 15]):
+            games = ingest(versions)
+            assert games.get_valid_games_count() == 3
+            assert games.get_duplicate_games_count() == 0
+
+    def test_stored_games_are_skipped(self, evaluation, games, binaries_folder):
+        evaluation.evaluate()
+        again = make_evaluation(games, binaries_folder, store=evaluation._store)
+        again.evaluate()
+        assert again.get_result_keys() == evaluation.get_result_keys()
+        assert again.get_telemetry().get_summary() == []
+        assert again.get_progress().get_status()["cache_hits"] == 24
+
+    def test_historical_versions(self, binaries_folder):
+        games = Games(
+            pgn=io.StringIO(make_pgn(num_games=2, plies=6, date="2020.06.01")),
+            stockfish_variant=StockfishVariant(),
+            log_level="none",
+        )
+        for historical, engines in ((True, [11, 11]), (False, [11, 11, 12, 12])):
+            evaluation = make_evaluation(
+                games,
+                binaries_folder,
+                stockfish_versions=[11, 12],
+                historical=historical,
+            )
+            evaluation.evaluate()
+            results = evaluation.get_results()
+            assert [r["engine"]["version"] for r in results] == engines
+
+    def test_continuous_evaluation(self, evaluation, games, binaries_folder):
+        evaluation.evaluate()
+        expected = [r["evaluation"] for r in evaluation.get_results()]
+        for reverse in (False, True):
+            continuous = make_evaluation(
+                games, binaries_folder, continuous=True, reverse=reverse
+            )
+            continuous.evaluate()
+            # the fake engine ignores the hash, so only the path to the position differs
+            assert [r["evaluation"] for r in continuous.get_results()] == expected
+            assert continuous._get_settings()["continuous"] == (
+                "reverse" if reverse else "forward"
+            )
+        assert "continuous" not in evaluation._get_settings()
+
+    def test_early_stop(self, games, binaries_folder, monkeypatch):
+        # with latency, the stop reaches the fake engine before it has finished the budget
+        monkeypatch.setenv("FAKE_STOCKFISH_LATENCY", "0.01")
+        summaries = []
+        for early_stop in (
+            None,
+            {"min_nodes": 100000, "stable_depths": 4, "stable_gap_cp": 0},
+        ):
+            evaluation = make_evaluation(
+                games, binaries_folder, num_nodes=["2M"], early_stop=early_stop
+            )
+            evaluation.evaluate()
+            summaries.append(evaluation.get_telemetry().get_summary()[0])
+        full, early = summaries
+        assert full["early_stops_total"] == 0
+        assert early["early_stops_total"] > 0
+        assert early["nodes_total"] < full["nodes_total"]
+        assert evaluation._get_settings()["early_stop"]["stable_gap_cp"] == 0
+
+        with pytest.raises(ValueError):
+            StockfishVariant.parse_early_stop({"stable_moves": 3})
+
+    def test_adaptive_multi_pv(self, binaries_folder):
+        # one random game, and one playing the engine's best moves that never needs widening
+        variant = StockfishVariant(
+            threads=1,
+            hash=16,
+            multi_pv=1,
+            binaries_folder=binaries_folder,
+            log_level="none",
+            initiate=True,
+        )
+        variant.set_num_nodes("100K")
+        game = chess.pgn.read_game(io.StringIO(make_pgn(num_games=1, plies=0, seed=1)))
+        board, node = chess.Board(), game
+        for _ in range(8):
+            variant.set_position(board.fen())
+            move = chess.Move.from_uci(variant.evaluate_position()[0]["Move"])
+            node = node.add_variation(move)
+            board.push(move)
+        variant.quit()
+        pgn = make_pgn(num_games=1, plies=8) + "\n" + str(game) + "\n"
+
+        evaluations = []
+        for adaptive_multi_pv in (None, 1):
+            games = Games(
+                pgn=io.StringIO(pgn),
+                stockfish_variant=StockfishVariant(),
+                log_level="none",
+            )
+            evaluation = make_evaluation(
+                games, binaries_folder, adaptive_multi_pv=adaptive_multi_pv
+            )
+            evaluation.evaluate()
+            evaluations.append(evaluation)
+        summary = evaluations[1].get_telemetry().get_summary()[0]
+        assert 0 < summary["widened_searches_total"] < summary["searches_total"]
+
+        # rank and centipawn loss of the played moves don't change
+        results = [e.get_results() for e in evaluations]
+        for expected, result in zip(*results):
+            moves = [
+                json.loads(Analysis(evaluation=r, log_level="none").analyse())["moves"]
+                for r in (expected, result)
+            ]
+            for key in ("top_engine_move", "centipawn_loss"):
+                assert [m[key] for m in moves[0]] == [m[key] for m in moves[1]]
+        assert all(len(e["evaluation"]) == 1 for e in results[1][1]["evaluation"])
+
+    def test_analyse_evaluation(self, evaluation):
+        evaluation.evaluate()
+        result = json.loads(
+            Analysis(evaluation=evaluation.get_results()[0], log_level="none").analyse()
+        )
+        assert len(result["moves"]) == 12
+
+    def test_cached_analysis(self, evaluation):
+        evaluation.evaluate()
+        key = evaluation.get_result_keys()[0]["key"]
+        store = evaluation._store
+        result = Analysis(store=store, key=key, log_level="none").analyse()
+        assert len(list(store.scan_iter("analysis:*"))) == 1
+
+        # a cached result doesn't read the evaluation
+        cached = Analysis(store=store, key=key, log_level="none")
+        assert cached.analyse() == result
+        assert cached._evaluation is None
+
+        cached.analyse(ignore_first_moves=0)
+        assert len(list(store.scan_iter("analysis:*"))) == 2
+        expired = Analysis(store=store, key=key, ttl=0, log_level="none")
+        expired.analyse(return_move_data=True)
+        assert store.get(expired._gen_cache_key()) is None
+
+    def test_analyse_from_archive(self, evaluation, tmp_path):
+        evaluation.evaluate()
+        key = evaluation.get_result_keys()[0]["key"]
+        archive = Archive(str(tmp_path / "archive"), log_level="none")
+        archive.export_store(evaluation._store)
+        result = Analysis(store=archive, key=key, log_level="none").analyse()
+        expected = Analysis(evaluation=evaluation.get_results()[0], log_level="none")
+        assert result == expected.analyse()
+        archive.close()
+
+    def test_profiler(self, evaluation):
+        profiler = Profiler(log_level="none").start()
+        evaluation.evaluate()
+        Analysis(evaluation=evaluation.get_results()[0], log_level="none").analyse()
+        profiler.stop()
+        summary = {item["stage"]: item for item in profiler.get_summary()}
+        for stage in ("engine_search", "store", "json", "evaluate_game", "analysis"):
+            assert summary[stage]["calls"] > 0
+        assert summary["engine_search"]["calls"] == 23
+        # the game stage includes the searches, its self time doesn't
+        game = summary["evaluate_game"]
+        assert (
+            game["self_seconds"]
+            < game["seconds"] - summary["engine_search"]["seconds"] + 0.001
+        )
+
+        # stopped, nothing is timed
+        evaluation.evaluate()
+        assert profiler.get_summary() == list(summary.values())
+
+    def test_telemetry(self, evaluation, tmp_path):
+        evaluation.evaluate()
+        summary = evaluation.get_telemetry().get_summary()
+        assert len(summary) == 1
+        assert summary[0]["positions_total"] == 24
+        # both games share the starting position
+        assert summary[0]["searches_total"] == 23
+        assert summary[0]["cache_hits_total"] == 1
+        assert summary[0]["nodes_total"] > 0
+        assert summary[0]["hashfull_max"] is not None
+
+        path = evaluation.get_telemetry().export(str(tmp_path / "metrics.prom"))
+        with open(path) as f:
+            metrics = f.read()
+        assert (
+            'catchfish_searches_total{version="15",threads="1",num_nodes="100K"} 23'
+            in metrics
+        )
+
+    def test_progress(self, games, binaries_folder, tmp_path):
+        status_file = str(tmp_path / "status.json")
+        evaluation = make_evaluation(games, binaries_folder, status_file=status_file)
+        evaluation.evaluate()
+        with open(status_file) as f:
+            status = json.load(f)
+        assert status["state"] == "finished"
+        assert status["percent"] == 100.0
+        assert status["positions_done"] == 23
+        assert status["cache_hits"] == 1
+        assert status["eta_seconds"] == 0
+
+    def test_progress_of_cached_positions(self, evaluation, games, binaries_folder):
+        evaluation.evaluate()
+        # a new store with only the position evaluations, so every position is a cache hit
+        store = MemoryStore(log_level="none")
+        for key in evaluation._store.scan_iter("position:*"):
+            store.set(key, evaluation._store.get(key))
+        again = make_evaluation(games, binaries_folder, store=store)
+        again.evaluate()
+        status = again.get_progress().get_status()
+        assert status["cache_hits"] == 24
+        assert status["nodes_total"] == 0
+        assert status["percent"] == 100.0
+
+    def test_quarantine(self, games, binaries_folder, monkeypatch):
+        poison = games.get_games()[0].get_positions()[3]
+        monkeypatch.setenv("FAKE_STOCKFISH_CRASH", poison)
+        settings = dict(max_position_retries=1, retry_backoff=0)
+        evaluation = make_evaluation(games, binaries_folder, **settings)
+        evaluation.evaluate()
+        assert evaluation._crashes == 2
+        assert len(evaluation.get_results()) == 2
+        # the quarantined position counts as done
+        status = evaluation.get_progress().get_status()
+        assert status["percent"] == 100.0
+        assert (status["positions_done"], status["quarantined"]) == (23, 1)
+        summary = evaluation.get_telemetry().get_summary()[0]
+        assert (summary["positions_total"], summary["quarantined_total"]) == (24, 1)
+        quarantine = evaluation.get_quarantine()
+        assert [q["position"] for q in quarantine] == [poison]
+
+        result = evaluation.get_results()[0]
+        assert result["evaluation"][3] == {
+            "evaluation": [],
+            "position": poison,
+            "quarantined": True,
+        }
+        analysis = json.loads(Analysis(evaluation=result, log_level="none").analyse())
+        assert analysis["moves"][3]["centipawn_loss"] is None
+
+        # known poison positions are skipped without touching the engine, also when the
+        # crash happened in a narrow search of adaptive MultiPV
+        for adaptive_multi_pv in (None, 1):
+            store = MemoryStore(log_level="none")
+            for crashes in (2, 0):
+                # the stored games are dropped, so their positions are looked up again
+                store.delete(*list(store.scan_iter("game:*")))
+                again = make_evaluation(
+                    games,
+                    binaries_folder,
+                    store=store,
+                    adaptive_multi_pv=adaptive_multi_pv,
+                    **settings,
+                )
+                again.evaluate()
+                assert again._crashes == crashes
+
+        # too many restarts in a row raise, instead of exiting the process
+        evaluation = make_evaluation(games, binaries_folder, max_restarts=0, **settings)
+        with pytest.raises(RuntimeError):
+            evaluation.evaluate()
+
+    def test_cache_hit_is_one_read(self, evaluation, monkeypatch):
+        store, keys, written = evaluation._store, [], []
+        get, put = store.get, store.set
+        monkeypatch.setattr(store, "get", lambda key: keys.append(key) or get(key))
+        monkeypatch.setattr(
+            store, "set", lambda key, *args: written.append(key) or put(key, *args)
+        )
+        evaluation.evaluate()
+        # the starting position of the second game is a cache hit: no quarantine probe, and
+        # its evaluation isn't written again
+        assert len([k for k in keys if k.startswith("quarantine:")]) == 23
+        assert len([k for k in written if k.startswith("position:")]) == 23
+
+    def test_distributed(self, evaluation, games, binaries_folder):
+        evaluation.evaluate()
+        distributed = make_evaluation(
+            games,
+            binaries_folder,
+            distributed=True,
+            local_workers=2,
+            poll_interval=0.01,
+        )
+        distributed.evaluate()
+        assert distributed.get_result_keys() == evaluation.get_result_keys()
+
+    def test_distributed_pinning(self, games, binaries_folder, monkeypatch):
+        pinned = []
+        monkeypatch.setattr(
+            StockfishVariant, "set_affinity", lambda self, cpus: pinned.append(cpus)
+        )
+        make_evaluation(
+            games,
+            binaries_folder,
+            distributed=True,
+            local_workers=1,
+            pin=True,
+            poll_interval=0.01,
+        ).evaluate()
+        assert pinned == [sorted(os.sched_getaffinity(0))]
+
+    def test_worker_releases_failed_job(self, tmp_path):
+        store = MemoryStore(log_level="none")
+        worker = Worker(
+            store=store,
+            binaries_folder=str(tmp_path / "missing"),
+            retry_backoff=0,
+            log_level="none",
+        )
+        job = {
+            "key": "position:x",
+            "fen": chess.STARTING_FEN,
+            "num_nodes": "100K",
+            "settings": {
+                "version": 15,
+                "threads": 1,
+                "hash": 16,
+                "depth": 20,
+                "multi_pv": 3,
+                "mode": "nodes",
+                "include_info": True,
+                "raw_output": False,
+            },
+        }
+        worker._queue.enqueue("position:x", job)
+        worker._process(*worker._queue.lease())
+        # no engine on this host, the job goes back to the queue without quarantine
+        job_id, leased = worker._queue.lease()
+        assert leased["attempts"] == 1
+        assert store.smembers("quarantine") == set()
+
+
+class TestJobQueue:
+    """
+    Test JobQueue class
+    """
+
+    @pytest.fixture
+    def queue(self):
+        return JobQueue(
+            MemoryStore(log_level="none"), lease_timeout=60, log_level="none"
+        )
+
+    def test_enqueue_once(self, queue):
+        assert queue.enqueue("a", {"fen": "x"})
+        assert not queue.enqueue("a", {"fen": "x"})
+        assert queue.size() == 1
+
+    def test_lease_and_ack(self, queue):
+        queue.enqueue("a", {"fen": "x"})
+        queue.enqueue("b", {"fen": "y"})
+        assert queue.lease() == ("a", {"fen": "x"})
+        queue.ack("a")
+        assert queue.size() == 1
+        assert queue.enqueue("a", {"fen": "x"})
+
+    def test_expired_lease_is_requeued(self, queue):
+        queue.enqueue("a", {"fen": "x"})
+        job_id, job = queue.lease()
+        assert queue.lease() is None
+        queue._lease_timeout = -1
+        queue.extend(job_id)
+        assert queue.requeue_expired() == 1
+        assert queue.lease()[0] == "a"
+
+    def test_priorities_and_fair_share(self, queue):
+        queue.enqueue("a", {"fen": "a"}, batch="x")
+        queue.enqueue("b", {"fen": "b"}, batch="x")
+        queue.enqueue("c", {"fen": "c"}, batch="y")
+        queue.enqueue("d", {"fen": "d"}, priority="batch", batch="z")
+        queue.enqueue("e", {"fen": "e"}, priority="interactive", batch="w")
+        leased = [queue.lease()[0] for _ in range(5)]
+        assert leased == ["e", "a", "c", "b", "d"]
+
+    def test_higher_priority_moves_job(self, queue):
+        queue.enqueue("a", {"fen": "a"}, priority="batch", batch="archive")
+        queue.enqueue("b", {"fen": "b"}, priority="batch", batch="archive")
+        assert not queue.enqueue(
+            "b", {"fen": "b"}, priority="interactive", batch="check"
+        )
+        assert queue.size(batch="check") == 1
+        assert queue.size(batch="archive") == 1
+        assert queue.lease()[0] == "b"
+        assert queue.size(batch="check") == 1
+        queue.ack("b")
+        assert queue.size(batch="check") == 0
+        assert queue.size() == 1
+
+
+class TestTuner:
+    """
+    Test Tuner class, using the fake UCI engine
+    """
+
+    def test_tune(self, tmp_path):
+        games = Games(
+            pgn=io.StringIO(make_pgn(num_games=2, plies=10)),
+            stockfish_variant=StockfishVariant(),
+            log_level="none",
+        )
+        tuner = Tuner(
+            games=games,
+            num_nodes="100K",
+            sample_size=6,
+            layouts=[
+                {"processes": 1, "threads": 1, "hash": 16},
+                {"processes": 2, "threads": 1, "hash": 8},
+            ],
+            pin=False,
+            binaries_folder=make_binaries_folder(tmp_path),
+            log_level="none",
+        )
+        assert len(tuner.get_sample()) == 6
+        best = tuner.tune()
+        results = tuner.get_results()
+        assert [r["processes"] for r in results] == [1, 2]
+        # the fastest layout wins, whichever it was on this host
+        fastest = max(results, key=lambda r: r["positions_per_hour"] or 0)
+        assert best == {k: fastest[k] for k in ("processes", "threads", "hash")}
+
+
+class TestCommandLine:
+    """
+    Test the command line
+    """
+
+    def test_import_is_lazy(self):
+        modules = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys, catchfish; print(sorted(set(sys.modules) & "
+                "{'redis', 'stockfish', 'chess', 'pydash'}))",
+            ],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout
+        assert modules.strip() == "[]"
+
+    def test_ingest(self, tmp_path, capsys):
+        pgn = tmp_path / "games.pgn"
+        pgn.write_text(make_pgn(num_games=3, plies=8))
+        main(["ingest", str(pgn)])
+        assert json.loads(capsys.readouterr().out) == {
+            "games": 3,
+            "invalid_games": 0,
+            "filtered_games": 0,
+            "duplicate_games": 0,
+            "positions": 24,
+        }
+
+    def test_profile(self, tmp_path, capsys):
+        pgn = tmp_path / "games.pgn"
+        pgn.write_text(make_pgn(num_games=3, plies=8))
+        report = tmp_path / "profile.txt"
+        main(
+            ["--profile", "cprofile", "--profile-file", str(report), "ingest", str(pgn)]
+        )
+        assert Profiler._active is None
+        text = report.read_text()
+        assert text.startswith("stage")
+        assert "pgn_parse" in text and "board_replay" in text
+        assert "== pgn_parse ==" in text
+
+    def test_stats(self, tmp_path, capsys):
+        status_file = tmp_path / "status.json"
+        status_file.write_text(json.dumps({"state": "running", "percent": 50.0}))
+        main(["stats", str(status_file)])
+        assert json.loads(capsys.readouterr().out)["status"]["percent"] == 50.0